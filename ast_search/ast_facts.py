@@ -0,0 +1,135 @@
+"""
+AstManager 需要的每个文件的事实：from-import 的原始模块名、level 和名字，类和它们的基类名。
+每个文件只 ast.parse 一次，多个文件用进程池并行解析；结果按 (相对路径, 内容 hash) 缓存到 sidecar json，
+update_version 再次运行时没改动的文件直接复用。
+import 的目标模块依赖仓库里有哪些文件，不能只按内容 hash 缓存，由调用方在运行时用 ModuleResolver 解析
+"""
+import os
+import ast
+import json
+import hashlib
+import itertools
+import concurrent.futures
+from ast_search.dependency_index import DEPENDENCY_INDEX_DIR
+
+# 少于这个数量的文件直接在当前进程解析，不值得启动进程池
+PARALLEL_MIN_FILES = 64
+# sidecar 的格式版本，facts 的结构变了就加一，旧文件直接丢弃
+FACT_CACHE_VERSION = 2
+
+
+def fact_cache_path(root_path):
+    key = hashlib.sha1(os.path.abspath(root_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(DEPENDENCY_INDEX_DIR, key + '.facts.json')
+
+
+def _read_file(file_full_path):
+    with open(file_full_path, 'rb') as f:
+        data = f.read()
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def extract_file_facts(file_full_path, root_path):
+    """
+    :return: (content_hash, facts)；读不了或解析失败时 facts 为 None
+        facts = {'imports': [[模块名, level, [名字, ...]], ...], 'classes': [[类名, [基类名, ...]], ...]}
+    """
+    try:
+        data, content_hash = _read_file(file_full_path)
+    except OSError:
+        return '', None
+    try:
+        tree = ast.parse(data.decode('utf-8'))
+    except Exception:
+        # failed to read/parse one file, we should ignore it
+        return content_hash, None
+
+    imports = []
+    classes = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom):
+            imports.append([node.module, node.level, [target.name for target in node.names]])
+        elif isinstance(node, ast.ClassDef):
+            classes.append([node.name, [base.id for base in node.bases if isinstance(base, ast.Name)]])
+    return content_hash, {'imports': imports, 'classes': classes}
+
+
+class FactCache:
+    def __init__(self, root_path, path=None):
+        self.root_path = root_path
+        self.path = path or fact_cache_path(root_path)
+        # 相对路径 -> {'hash': 内容 hash, 'facts': facts}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get('version') == FACT_CACHE_VERSION:
+                    self.entries = data['entries']
+            except (OSError, ValueError, AttributeError, KeyError):
+                self.entries = {}
+
+    def _lookup(self, file_full_path):
+        entry = self.entries.get(os.path.relpath(file_full_path, self.root_path))
+        if entry is None:
+            return False, None
+        try:
+            _, content_hash = _read_file(file_full_path)
+        except OSError:
+            return False, None
+        if entry['hash'] != content_hash:
+            return False, None
+        return True, entry['facts']
+
+    def _store(self, file_full_path, content_hash, facts):
+        self.entries[os.path.relpath(file_full_path, self.root_path)] = {'hash': content_hash, 'facts': facts}
+        self.dirty = True
+
+    def get(self, file_full_path):
+        found, facts = self._lookup(file_full_path)
+        if found:
+            self.hits += 1
+            return facts
+        self.misses += 1
+        content_hash, facts = extract_file_facts(file_full_path, self.root_path)
+        self._store(file_full_path, content_hash, facts)
+        return facts
+
+    def get_many(self, py_files, max_workers=4):
+        """
+        :return: {file_full_path: facts}，缓存里没有的文件用进程池并行解析
+        """
+        result = {}
+        missing = []
+        for file_full_path in py_files:
+            found, facts = self._lookup(file_full_path)
+            if found:
+                self.hits += 1
+                result[file_full_path] = facts
+            else:
+                missing.append(file_full_path)
+        self.misses += len(missing)
+
+        if max_workers > 1 and len(missing) >= PARALLEL_MIN_FILES:
+            chunksize = max(1, len(missing) // (max_workers * 4))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                extracted = list(executor.map(extract_file_facts, missing, itertools.repeat(self.root_path),
+                                              chunksize=chunksize))
+        else:
+            extracted = [extract_file_facts(file_full_path, self.root_path) for file_full_path in missing]
+
+        for file_full_path, (content_hash, facts) in zip(missing, extracted):
+            self._store(file_full_path, content_hash, facts)
+            result[file_full_path] = facts
+        return result
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'version': FACT_CACHE_VERSION, 'entries': self.entries}, f)
+        self.dirty = False
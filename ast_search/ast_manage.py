@@ -1,62 +1,75 @@
 import os
-import ast
-import pathlib
-from ast_search.ast_utils import get_py_files, get_dotted_name, get_module_name, module_name_to_path, TimerDecorator, method_decorator
-from graph_database_index.graphDB import GraphDatabaseHandler
+from ast_search.ast_facts import FactCache
+from ast_search.ast_utils import get_py_files, get_dotted_name, get_module_resolver, TimerDecorator, method_decorator
+from graph_database_index.graphDB import create_graph_handler
 
 
 class AstManager:
-    def __init__(self, project_path: str, task_id: str):
+    def __init__(self, project_path: str, task_id: str, version=None, max_workers=4):
+        """
+        :param max_workers: 并行解析文件的进程数
+        """
         self.project_path = project_path
         self.root_path = project_path
-        self.graphDB = GraphDatabaseHandler(uri="http://localhost:7474",
-                                             user="neo4j",
-                                             password="12345678",
-                                             database_name='neo4j',
-                                             task_id=task_id,
-                                             use_lock=True)
+        # 边先缓冲，run() 结束时批量写入
+        self.graphDB = create_graph_handler(task_id=task_id, version=version, batch_size=1000)
         self.task_id = task_id
         # self._build_index()
         self.class_inherited = {}
-        self.processed_relations = set()  # 用于记录已经处理过的关系
-        self.visited = []
+        self.visited = set()
+        self.max_workers = max_workers
+        # 每个文件只解析一次，解析结果按内容 hash 缓存
+        self.fact_cache = FactCache(project_path)
+        self.file_facts = {}
+        # 点分模块名 <-> 文件路径的索引，import 解析不再访问文件系统
+        self.resolver = get_module_resolver(project_path)
+        # 内存里的 MODULE -[:CONTAINS]-> 表：module -> {'members': {full_name: (name, label)}, 'names': {name: (full_name, label)}}
+        self.module_contains = None
+
+    def get_file_facts(self, file_full_path):
+        if file_full_path not in self.file_facts:
+            self.file_facts[file_full_path] = self.fact_cache.get(file_full_path)
+        return self.file_facts[file_full_path]
+
+    def get_cur_module_full_name(self, file_full_path):
+        if '__init__.py' in file_full_path:
+            return get_dotted_name(self.root_path, os.path.dirname(file_full_path))
+        else:
+            return get_dotted_name(self.root_path, file_full_path)
+
+    def load_module_contains(self):
+        """
+        一次查询把任务里已有的 CONTAINS 关系读进内存，之后的 import 解析都在内存里完成
+        """
+        self.module_contains = {}
+        for module_full_name, name, full_name, label in self.graphDB.get_module_contains():
+            self._add_module_member(module_full_name, name, full_name, label)
+
+    def _add_module_member(self, module_full_name, name, full_name, label):
+        entry = self.module_contains.setdefault(module_full_name, {'members': {}, 'names': {}})
+        entry['members'].setdefault(full_name, (name, label))
+        if name is not None:
+            entry['names'].setdefault(name, (full_name, label))
 
     def get_full_name_from_graph(self, module_full_name, target_name):
-        query = f"""
-MATCH (m:MODULE:`{self.task_id}` {{full_name: '{module_full_name}'}})-[:CONTAINS]->(c:`{self.task_id}` {{name: '{target_name}'}})
-RETURN c.full_name as full_name, labels(c) AS labels
-"""
-        response = self.graphDB.execute_query(query)
-        if response:
-            full_name, labels = response[0]['full_name'], response[0]['labels']
-            label = next(l for l in labels if l in ['MODULE', 'CLASS', 'FUNCTION', 'METHOD', 'GLOBAL_VARIABLE', 'FIELD'])
-            return full_name, label
-        else:
+        if self.module_contains is None:
+            self.load_module_contains()
+        entry = self.module_contains.get(module_full_name)
+        if entry is None or target_name not in entry['names']:
             return None, None
+        return entry['names'][target_name]
 
     def get_all_name_from_graph(self, module_full_name):
-        query = f"""
-MATCH (m:MODULE:`{self.task_id}` {{full_name: '{module_full_name}'}})-[:CONTAINS]->(c:`{self.task_id}`)
-RETURN c.full_name as full_name, labels(c) AS labels
-"""
-        def get_type_label(labels):
-            label = next(l for l in labels if l in ['MODULE', 'CLASS', 'FUNCTION', 'METHOD', 'GLOBAL_VARIABLE', 'FIELD'])
-            return label
-        response = self.graphDB.execute_query(query)
-
-        if response:
-            return [[record['full_name'], get_type_label(record['labels'])] for record in response]
-        else:
-            return None, None
+        if self.module_contains is None:
+            self.load_module_contains()
+        entry = self.module_contains.get(module_full_name)
+        if entry is None:
+            return []
+        return [[full_name, label] for full_name, (name, label) in entry['members'].items()]
 
     def get_all_method_of_class(self, class_full_name):
-        query = f"""
-MATCH (c:CLASS:`{self.task_id}` {{full_name: '{class_full_name}'}})-[:HAS_METHOD]->(m:`{self.task_id}`)
-RETURN m.full_name as full_name
-"""
-        response = self.graphDB.execute_query(query)
-        if response:
-            methods = [record['full_name'] for record in response]
+        methods = self.graphDB.get_methods_of_class(class_full_name)
+        if methods:
             return methods
         else:
             return None
@@ -65,6 +78,10 @@ RETURN m.full_name as full_name
     def run(self, py_files=None):
         if py_files is None:
             py_files = get_py_files(self.project_path)
+            self.resolver.update(py_files)
+
+        self.file_facts.update(self.fact_cache.get_many(py_files, max_workers=self.max_workers))
+        self.load_module_contains()
 
         for py_file in py_files:
             self.build_modules_contain(py_file)
@@ -72,31 +89,50 @@ RETURN m.full_name as full_name
         for py_file in py_files:
             self.build_inherited(py_file)
 
-        for cur_class_full_name in self.class_inherited.keys():
-            for base_class_full_name in self.class_inherited[cur_class_full_name]:
-                self._build_inherited_method(cur_class_full_name, base_class_full_name)
-
-    def _build_inherited_method(self, cur_class_full_name, base_class_full_name):
-        # 创建一个关系的唯一标识符
-        relation_key = (cur_class_full_name, base_class_full_name)
-        # 如果这个关系已经处理过，直接返回
-        if relation_key in self.processed_relations:
-            return
-        # 将当前关系标记为已处理
-        self.processed_relations.add(relation_key)
-
-        methods = self.get_all_method_of_class(base_class_full_name)
-        if methods is None:
-            return
-        for method in methods:
-            if '__init__' in method:
-                continue
-            edge = self.graphDB.add_edge(start_label='CLASS', start_name=cur_class_full_name,
-                                         relationship_type='HAS_METHOD', end_name=method)
+        self.build_inherited_methods()
+
+        self.graphDB.flush()
+        self.fact_cache.save()
 
-        if base_class_full_name in self.class_inherited.keys():
-            for base_base_class_full_name in self.class_inherited[base_class_full_name]:
-                self._build_inherited_method(cur_class_full_name, base_base_class_full_name)
+    def build_inherited_methods(self):
+        """
+        一次取出所有 HAS_METHOD 和 INHERITS，在内存里按 MRO 算出每个类继承到的方法：
+        MRO 里靠前的类（包括自己）定义过的同名方法会覆盖后面的，__init__ 不继承
+        """
+        # 类自己定义的方法：class -> {方法名: full_name}，之前继承来的 HAS_METHOD（inherited 标记）不算
+        own_methods = {}
+        for class_full_name, method_full_name, params in self.graphDB.get_relations('HAS_METHOD', with_params=True):
+            if params.get('inherited'):
+                continue
+            prefix = class_full_name + '.'
+            if method_full_name.startswith(prefix) and '.' not in method_full_name[len(prefix):]:
+                own_methods.setdefault(class_full_name, {})[method_full_name[len(prefix):]] = method_full_name
+
+        # 本次解析过的类用源码里的基类顺序，其余类按 INHERITS 边上记录的 base_index 排序
+        indexed_bases = {}
+        for class_full_name, base_class_full_name, params in self.graphDB.get_relations('INHERITS', with_params=True):
+            base_index = params.get('base_index')
+            indexed_bases.setdefault(class_full_name, []).append(
+                (base_index is None, base_index or 0, base_class_full_name))
+        bases_of = {class_full_name: [base for _, _, base in sorted(bases)]
+                    for class_full_name, bases in indexed_bases.items()}
+        for class_full_name, base_class_full_names in self.class_inherited.items():
+            bases_of[class_full_name] = [base for base in base_class_full_names if base]
+
+        # 先删掉这些类之前继承来的方法，基类改了或者方法被覆盖之后不会留下旧的边
+        self.graphDB.delete_relations('HAS_METHOD', list(self.class_inherited.keys()), 'inherited')
+
+        mro_cache = {}
+        for cur_class_full_name in self.class_inherited.keys():
+            defined = set(own_methods.get(cur_class_full_name, {}).keys())
+            for base_class_full_name in get_mro(cur_class_full_name, bases_of, mro_cache)[1:]:
+                for method_name, method in own_methods.get(base_class_full_name, {}).items():
+                    if method_name == '__init__' or method_name in defined:
+                        continue
+                    defined.add(method_name)
+                    self.graphDB.add_edge(start_label='CLASS', start_name=cur_class_full_name,
+                                          relationship_type='HAS_METHOD', end_name=method,
+                                          params={'inherited': True})
 
     def _build_modules_contain_edge(self, target_module_full_name, target_name, cur_module_full_name):
         target_full_name, target_label = self.get_full_name_from_graph(target_module_full_name, target_name)
@@ -106,6 +142,8 @@ RETURN m.full_name as full_name
         edge = self.graphDB.add_edge(start_label='MODULE', start_name=cur_module_full_name,
                                      relationship_type='CONTAINS', end_name=target_full_name,
                                      params={"association_type": target_label})
+        # re-export：导入的名字之后也能从当前模块解析到
+        self._add_module_member(cur_module_full_name, target_name, target_full_name, target_label)
         return edge is not None
 
     def _build_modules_contain_edge_all(self, target_module_full_name, cur_module_full_name):
@@ -114,6 +152,7 @@ RETURN m.full_name as full_name
         if not target_list:
             return False
 
+        names = self.module_contains[target_module_full_name]['members']
         for target_full_name, target_label in target_list:
             # print(cur_module_full_name, '->', target_full_name, target_name)
             edge = self.graphDB.add_edge(start_label='MODULE', start_name=cur_module_full_name,
@@ -121,84 +160,115 @@ RETURN m.full_name as full_name
                                          params={"association_type": target_label})
             if not edge:
                 return False
+            self._add_module_member(cur_module_full_name, names[target_full_name][0], target_full_name, target_label)
 
         return True
 
     def build_modules_contain(self, file_full_path):
         if file_full_path in self.visited:
             return None
-        self.visited.append(file_full_path)
+        self.visited.add(file_full_path)
 
-        try:
-            file_content = pathlib.Path(file_full_path).read_text()
-            tree = ast.parse(file_content)
-        except Exception:
+        facts = self.get_file_facts(file_full_path)
+        if facts is None:
             # failed to read/parse one file, we should ignore it
             return None
 
-        if '__init__.py' in file_full_path:
-            cur_module_full_name = get_dotted_name(self.root_path, os.path.dirname(file_full_path))
-        else:
-            cur_module_full_name = get_dotted_name(self.root_path, file_full_path)
+        cur_module_full_name = self.get_cur_module_full_name(file_full_path)
 
-        for node in ast.walk(tree):
-            if not isinstance(node, ast.ImportFrom):
-                continue
-            target_module_full_name = get_module_name(file_full_path, node, self.root_path)
+        for module, level, target_names in facts['imports']:
+            # 目标模块在运行时按当前的文件列表解析，文件增删后缓存的 facts 仍然可用
+            target_module_full_name = self.resolver.resolve_import(file_full_path, module, level)
             if not target_module_full_name:
                 continue
-
-            for target in node.names:
-                target_name = target.name
-
+            for target_name in target_names:
                 if target_name == '*':
                     if not self._build_modules_contain_edge_all(target_module_full_name, cur_module_full_name):
-                        module_path = module_name_to_path(target_module_full_name, self.root_path)
-                        file_path = os.path.join(self.root_path, module_path, '__init__.py')
-                        if os.path.exists(file_path):
+                        file_path = self.resolver.package_init(target_module_full_name)
+                        if file_path is not None:
                             self.build_modules_contain(file_path)
                     self._build_modules_contain_edge_all(target_module_full_name, cur_module_full_name)
                 else:
                     if not self._build_modules_contain_edge(target_module_full_name, target_name ,cur_module_full_name):
-                        module_path = module_name_to_path(target_module_full_name, self.root_path)
-                        file_path = os.path.join(self.root_path, module_path, '__init__.py')
-                        if os.path.exists(file_path):
+                        file_path = self.resolver.package_init(target_module_full_name)
+                        if file_path is not None:
                             self.build_modules_contain(file_path)
                     self._build_modules_contain_edge(target_module_full_name, target_name ,cur_module_full_name)
 
     def build_inherited(self, file_full_path):
-        try:
-            file_content = pathlib.Path(file_full_path).read_text()
-            tree = ast.parse(file_content)
-        except Exception:
+        facts = self.get_file_facts(file_full_path)
+        if facts is None:
             # failed to read/parse one file, we should ignore it
             return None
 
-        if '__init__.py' in file_full_path:
-            cur_module_full_name = get_dotted_name(self.root_path, os.path.dirname(file_full_path))
-        else:
-            cur_module_full_name = get_dotted_name(self.root_path, file_full_path)
+        cur_module_full_name = self.get_cur_module_full_name(file_full_path)
 
-        for node in ast.walk(tree):
-            if not isinstance(node, ast.ClassDef):
-                continue
-            class_name = node.name
+        for class_name, base_names in facts['classes']:
             cur_class_full_name = cur_module_full_name + '.' + class_name
-            for base in node.bases:
-                if not isinstance(base, ast.Name):
-                    continue
-                base_class_full_name, _ = self.get_full_name_from_graph(cur_module_full_name, base.id)
+            # 没有基类的类也要登记，之前继承来的方法才会被清掉
+            self.class_inherited.setdefault(cur_class_full_name, [])
+            for base_index, base_name in enumerate(base_names):
+                base_class_full_name, _ = self.get_full_name_from_graph(cur_module_full_name, base_name)
                 if base_class_full_name is None:
-                    print('base_class_full_name is None: ', cur_class_full_name, base.id)
-                if cur_class_full_name not in self.class_inherited.keys():
-                    self.class_inherited[cur_class_full_name] = []
+                    print('base_class_full_name is None: ', cur_class_full_name, base_name)
                 self.class_inherited[cur_class_full_name].append(base_class_full_name)
                 if base_class_full_name:
                     edge = self.graphDB.add_edge(start_name=cur_class_full_name,
-                                                 relationship_type='INHERITS', end_name=base_class_full_name)
+                                                 relationship_type='INHERITS', end_name=base_class_full_name,
+                                                 params={'base_index': base_index})
                 # self._build_inherited_method(cur_class_full_name, base_class_full_name)
 
 
+def get_mro(class_full_name, bases_of, cache, visiting=None):
+    """
+    C3 线性化；基类顺序冲突或有循环继承时退回深度优先、从左到右去重的顺序
+    """
+    if class_full_name in cache:
+        return cache[class_full_name]
+    if visiting is None:
+        visiting = set()
+    if class_full_name in visiting:
+        return [class_full_name]
+    visiting.add(class_full_name)
+    bases = bases_of.get(class_full_name, [])
+    sequences = [list(get_mro(base, bases_of, cache, visiting)) for base in bases] + [list(bases)]
+    visiting.discard(class_full_name)
+
+    mro = [class_full_name]
+    while True:
+        sequences = [sequence for sequence in sequences if sequence]
+        if not sequences:
+            break
+        for sequence in sequences:
+            head = sequence[0]
+            if not any(head in other[1:] for other in sequences):
+                break
+        else:
+            mro = _dfs_mro(class_full_name, bases_of)
+            break
+        if head in mro:
+            mro = _dfs_mro(class_full_name, bases_of)
+            break
+        mro.append(head)
+        for sequence in sequences:
+            if sequence[0] == head:
+                del sequence[0]
+    cache[class_full_name] = mro
+    return mro
+
+
+def _dfs_mro(class_full_name, bases_of):
+    mro = []
+    stack = [class_full_name]
+    while stack:
+        current = stack.pop()
+        if current in mro:
+            continue
+        mro.append(current)
+        stack.extend(reversed(bases_of.get(current, [])))
+    return mro
+
+
 
 
 if __name__ == '__main__':
@@ -50,66 +50,122 @@ def convert_dotted_name(root_path, file_path):
         return None, None
 
 
-def get_dotted_name(root_path, file_path):
-    def _get_dotted_name(path):
-        rest = path[len(root_path):]
-        split = [s for s in rest.split(os.path.sep) if s != '']
-        return '.'.join(split)
-    if '.py' in file_path:
-        return _get_dotted_name(file_path.split('.py')[0])
-    else:
-        return _get_dotted_name(file_path)
+class ModuleResolver:
+    """
+    一个仓库的模块解析索引：点分模块名 <-> 文件路径，以及包的 __init__.py。
+    由文件列表一次建好，之后的解析都只查字典，不再对文件系统做 os.path.exists
+    """
+    def __init__(self, root_path, py_files=None):
+        self.root_path = root_path
+        # 点分名 -> xxx.py 的路径
+        self.modules = {}
+        # 包的点分名 -> __init__.py 的路径
+        self.packages = {}
+        # 文件 / 目录路径 -> 点分名
+        self.dotted_names = {}
+        self.update(get_py_files(root_path) if py_files is None else py_files)
+
+    def _dotted_name(self, path):
+        dotted_name = self.dotted_names.get(path)
+        if dotted_name is None:
+            rest = path[len(self.root_path):]
+            dotted_name = '.'.join(s for s in rest.split(os.path.sep) if s != '')
+            self.dotted_names[path] = dotted_name
+        return dotted_name
+
+    def add_file(self, file_path):
+        module_name = self._dotted_name(file_path.split('.py')[0])
+        self.modules[module_name] = file_path
+        if os.path.basename(file_path) == '__init__.py':
+            self.packages[self._dotted_name(os.path.dirname(file_path))] = file_path
+
+    def remove_file(self, file_path):
+        module_name = self._dotted_name(file_path.split('.py')[0])
+        if self.modules.get(module_name) == file_path:
+            del self.modules[module_name]
+        if os.path.basename(file_path) == '__init__.py':
+            package_name = self._dotted_name(os.path.dirname(file_path))
+            if self.packages.get(package_name) == file_path:
+                del self.packages[package_name]
+
+    def update(self, py_files):
+        """
+        和当前的完整文件列表对齐：加入新文件，去掉已经不存在的文件
+        """
+        current = set(py_files)
+        known = set(self.modules.values()) | set(self.packages.values())
+        for file_path in known - current:
+            self.remove_file(file_path)
+        for file_path in current - known:
+            self.add_file(file_path)
+
+    def module_file(self, module_name):
+        """
+        :return: 模块对应的 xxx.py 或 xxx/__init__.py，不在仓库里时为 None
+        """
+        return self.modules.get(module_name) or self.packages.get(module_name)
+
+    def package_init(self, module_name):
+        return self.packages.get(module_name)
+
+    def get_dotted_name(self, file_path):
+        if '.py' in file_path:
+            return self._dotted_name(file_path.split('.py')[0])
+        return self._dotted_name(file_path)
+
+    def module_name_to_path(self, module_name):
+        return os.path.normpath(os.path.join(self.root_path, module_name.replace('.', os.sep)))
+
+    def get_module_name(self, file_path, node):
+        return self.resolve_import(file_path, node.module, node.level)
+
+    def resolve_import(self, file_path, module, level):
+        """
+        :return: from-import 目标模块的点分名，不在仓库里时为 None；module / level 同 ast.ImportFrom
+        """
+        if module is not None and self.module_file(module) is not None:
+            return module
+
+        # Construct the relative path
+        if level > 0:
+            relative_path = "." * level + os.path.sep + (module if module else "")
+        else:
+            relative_path = module if module else ""
+        # Get the absolute path of the module
+        absolute_path = os.path.abspath(os.path.join(os.path.dirname(file_path), relative_path))
+
+        if absolute_path.startswith(self.root_path):
+            return self._dotted_name(absolute_path)
+        return None
 
 
-def get_module_name(file_path, node, working_path):
+# root_path -> ModuleResolver，每个进程里每个仓库只建一次
+_module_resolvers = {}
 
-    file_dir_path = os.path.dirname(file_path)
-    def get_dotted_name(path):
-        rest = path[len(working_path):]
-        split = [s for s in rest.split(os.path.sep) if s != '']
-        return '.'.join(split)
 
-    node_path = str(node.module).replace('.', os.path.sep)
+def get_module_resolver(root_path, py_files=None):
+    """
+    :param py_files: 传入时用完整文件列表增量更新索引（文件增删之后调用）
+    """
+    resolver = _module_resolvers.get(root_path)
+    if resolver is None:
+        resolver = _module_resolvers[root_path] = ModuleResolver(root_path, py_files)
+    elif py_files is not None:
+        resolver.update(py_files)
+    return resolver
 
-    # print('is ', os.path.join(working_path, node_path + '.py'))
-    if os.path.exists(os.path.join(working_path, node_path+'.py')):
-        # print('is ', os.path.join(working_path, node_path + '.py'), node.module)
-        return node.module
-    if os.path.exists(os.path.join(working_path, node_path, '__init__.py')):
-        # print('is ', os.path.join(working_path, node_path + '.py'), node.module)
-        return node.module
 
-    # Construct the relative path
-    if node.level > 0:
-        relative_path = "." * node.level + os.path.sep + (node.module if node.module else "")
-    else:
-        relative_path = node.module if node.module else ""
-    # Get the absolute path of the module
-    current_file_path = os.path.abspath(file_dir_path)
-    absolute_path = os.path.abspath(os.path.join(current_file_path, relative_path))
-
-    if absolute_path.startswith(working_path):
-        module_path = get_dotted_name(absolute_path)
-        return module_path
-    else:
-        return None
+def get_dotted_name(root_path, file_path):
+    return get_module_resolver(root_path).get_dotted_name(file_path)
 
-    # Calculate the relative path to the working path
-    # relative_to_working_path = os.path.relpath(absolute_path, )
-    # Convert file system path to module path
-    # module_path = relative_to_working_path.replace(os.sep, '.')
 
+def get_module_name(file_path, node, working_path):
+    return get_module_resolver(working_path).get_module_name(file_path, node)
 
 
 def module_name_to_path(module_path, working_path):
     # Convert module path to file path
-    relative_file_path = module_path.replace('.', os.sep)
-    absolute_file_path = os.path.join(working_path, relative_file_path)
-
-    # Normalize the path to handle any redundant separators
-    absolute_file_path = os.path.normpath(absolute_file_path)
-
-    return absolute_file_path
+    return get_module_resolver(working_path).module_name_to_path(module_path)
 
 if __name__ == '__main__':
     repo_path = r'/home/lanbo/repo/test_repo'
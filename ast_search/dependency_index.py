@@ -0,0 +1,140 @@
+"""
+仓库内部的 import 依赖索引：file -> 它 import 的仓库内文件，以及反向的 file -> import 它的文件。
+保存在 sidecar json 里，按文件内容 hash 增量更新；update_version 用它算出改动文件影响到的最小文件集合
+"""
+import os
+import ast
+import json
+import pathlib
+from ast_search.ast_utils import get_py_files, get_module_name, get_module_resolver
+from graph_database_index.incremental import file_content_hash
+
+DEPENDENCY_INDEX_DIR = os.environ.get('CODE_GRAPH_CACHE',
+                                      os.path.join(os.path.expanduser('~'), '.cache', 'code_graph'))
+
+
+def dependency_index_path(task_id):
+    return os.path.join(DEPENDENCY_INDEX_DIR, task_id.replace('/', '_') + '.deps.json')
+
+
+class DependencyIndex:
+    def __init__(self, root_path):
+        self.root_path = root_path
+        # 相对路径 -> {'hash': 内容 hash, 'imports': [相对路径]}
+        self.files = {}
+        self._reverse = None
+
+    def _relative_path(self, file_path):
+        return os.path.relpath(file_path, self.root_path)
+
+    def _module_to_file(self, module_name):
+        file_path = get_module_resolver(self.root_path).module_file(module_name)
+        if file_path is None:
+            return None
+        return self._relative_path(file_path)
+
+    def _parse_imports(self, file_path):
+        try:
+            tree = ast.parse(pathlib.Path(file_path).read_text())
+        except Exception:
+            return []
+        imports = set()
+        for node in ast.walk(tree):
+            module_names = []
+            if isinstance(node, ast.Import):
+                module_names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                module_name = get_module_name(file_path, node, self.root_path)
+                if not module_name:
+                    continue
+                # from pkg import submodule 也依赖 pkg/submodule.py
+                module_names = [module_name] + [module_name + '.' + alias.name for alias in node.names
+                                                if alias.name != '*']
+            for module_name in module_names:
+                dependency = self._module_to_file(module_name)
+                if dependency:
+                    imports.add(dependency)
+        imports.discard(self._relative_path(file_path))
+        return sorted(imports)
+
+    def update(self, py_files=None):
+        """
+        重新解析内容变化的文件，删除已经不存在的文件
+        :return: 重新解析的文件的相对路径
+        """
+        if py_files is None:
+            py_files = get_py_files(self.root_path)
+        get_module_resolver(self.root_path, py_files)
+        updated = []
+        current = set()
+        for file_path in py_files:
+            relative_path = self._relative_path(file_path)
+            current.add(relative_path)
+            content_hash = file_content_hash(file_path)
+            entry = self.files.get(relative_path)
+            if entry is not None and entry['hash'] == content_hash:
+                continue
+            self.files[relative_path] = {'hash': content_hash, 'imports': self._parse_imports(file_path)}
+            updated.append(relative_path)
+        for relative_path in list(self.files.keys()):
+            if relative_path not in current:
+                del self.files[relative_path]
+        self._reverse = None
+        return updated
+
+    def update_paths(self, changed_files=(), deleted_files=()):
+        """
+        只重新解析给出的文件，不扫描整个仓库（监听模式下每批改动调用）
+        :param changed_files: 新增或改动的文件
+        :param deleted_files: 已删除的文件
+        """
+        resolver = get_module_resolver(self.root_path)
+        for file_path in deleted_files:
+            resolver.remove_file(file_path)
+            self.files.pop(self._relative_path(file_path), None)
+        for file_path in changed_files:
+            resolver.add_file(file_path)
+        for file_path in changed_files:
+            self.files[self._relative_path(file_path)] = {'hash': file_content_hash(file_path),
+                                                          'imports': self._parse_imports(file_path)}
+        self._reverse = None
+
+    def reverse_dependencies(self):
+        if self._reverse is None:
+            self._reverse = {}
+            for relative_path, entry in self.files.items():
+                for dependency in entry['imports']:
+                    self._reverse.setdefault(dependency, set()).add(relative_path)
+        return self._reverse
+
+    def dependents(self, changed_files):
+        """
+        传递地找出 import 了改动文件的文件（re-export 和继承链都会沿 import 传递），不包含改动文件本身
+        :param changed_files: 相对 root_path 的路径
+        """
+        reverse = self.reverse_dependencies()
+        changed = set(os.path.normpath(file_path) for file_path in changed_files)
+        affected = set()
+        stack = list(changed)
+        while stack:
+            for dependent in reverse.get(stack.pop(), ()):
+                if dependent not in affected and dependent not in changed:
+                    affected.add(dependent)
+                    stack.append(dependent)
+        return sorted(affected)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'root_path': self.root_path, 'files': self.files}, f)
+
+    @classmethod
+    def load(cls, path, root_path):
+        index = cls(root_path)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    index.files = json.load(f).get('files', {})
+            except (OSError, ValueError):
+                index.files = {}
+        return index
@@ -0,0 +1,116 @@
+"""
+process_string 还原 <CODE>{...}</CODE> 用的源码缓存。
+文件用 mmap 打开，预先算好每一行的起始偏移，取第 S~E 行只是一次切片；
+多个文件按占用字节数和文件数做 LRU 淘汰，文件的 mtime / size 变了就重新加载。
+淘汰会关闭 mmap：取代码用 lines()，切片在锁里完成，别的线程不会在中途把文件关掉
+"""
+import os
+import re
+import mmap
+import array
+import threading
+from collections import OrderedDict
+
+# 缓存占用（文件大小 + 行偏移表）的上限
+CODE_CACHE_MAX_BYTES = int(os.environ.get('CODE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# 每个 mmap 占一个文件描述符，缓存的文件数也要有上限，避免 EMFILE
+CODE_CACHE_MAX_FILES = int(os.environ.get('CODE_CACHE_MAX_FILES', '256'))
+
+
+class LineIndexedFile:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        stat = os.stat(file_path)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size > 0:
+            # mmap 建好之后就不需要原来的文件对象了
+            with open(file_path, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # 空文件不能 mmap
+            self.data = b''
+        # 第 i 行（从 0 开始）的起始偏移，和 str.split('\n') 的切分一致
+        self.line_starts = array.array('q', [0])
+        self.line_starts.extend(match.end() for match in re.finditer(b'\n', self.data))
+        self.nbytes = stat.st_size + self.line_starts.itemsize * len(self.line_starts)
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def lines(self, start_line, end_line):
+        """
+        :return: 第 start_line ~ end_line 行（从 1 开始，包含两端），语义同 lines[start_line-1:end_line]
+        """
+        count = len(self.line_starts)
+        start = max(start_line - 1, 0)
+        end = min(end_line if end_line >= 0 else max(count + end_line, 0), count)
+        if start >= end:
+            return []
+        stop = self.line_starts[end] - 1 if end < count else len(self.data)
+        return self.data[self.line_starts[start]:stop].decode('utf-8').split('\n')
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class FileLineCache:
+    def __init__(self, max_bytes=CODE_CACHE_MAX_BYTES, max_files=CODE_CACHE_MAX_FILES):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        """
+        :return: LineIndexedFile；文件不存在或读不了时抛 OSError。
+            释放锁之后它随时可能被别的线程淘汰（mmap 关闭），只用来看行数之类的信息，取代码用 lines()
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            return self._get_locked(file_path, stat)
+
+    def lines(self, file_path, start_line, end_line):
+        """
+        :return: 第 start_line ~ end_line 行，语义同 LineIndexedFile.lines；文件不存在或读不了时抛 OSError
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            return self._get_locked(file_path, stat).lines(start_line, end_line)
+
+    def _get_locked(self, file_path, stat):
+        entry = self._files.get(file_path)
+        if entry is not None and entry.stamp == (stat.st_mtime_ns, stat.st_size):
+            self._files.move_to_end(file_path)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if entry is not None:
+            self._evict(file_path)
+        entry = LineIndexedFile(file_path)
+        self._files[file_path] = entry
+        self.nbytes += entry.nbytes
+        # 至少保留刚加载的文件
+        while (self.nbytes > self.max_bytes or len(self._files) > self.max_files) and len(self._files) > 1:
+            self._evict(next(iter(self._files)))
+        return entry
+
+    def _evict(self, file_path):
+        entry = self._files.pop(file_path)
+        self.nbytes -= entry.nbytes
+        entry.close()
+
+    def clear(self):
+        with self._lock:
+            for file_path in list(self._files.keys()):
+                self._evict(file_path)
+
+    def stats(self):
+        return {'files': len(self._files), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+# 进程内共用的缓存
+code_cache = FileLineCache()
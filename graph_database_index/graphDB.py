@@ -1,11 +1,52 @@
 import os
 
-from py2neo import Graph, Node, NodeMatcher, Relationship, RelationshipMatcher
+from py2neo import Graph
 import fasteners
 import subprocess
-import codecs
 import re
 import json
+import time
+import random
+import tempfile
+import threading
+import itertools
+from urllib.parse import urlparse
+from graph_database_index.queries import KIND_LABELS, NONE_LABEL, render, version_filter
+from graph_database_index.code_cache import code_cache
+from graph_database_index.query_cache import shared_query_cache, invalidate_task, is_write_query
+
+# 连接配置：可以用环境变量覆盖，例如 NEO4J_URI=bolt://localhost:7687 走 Bolt 协议
+NEO4J_URI = os.environ.get('NEO4J_URI', 'http://localhost:7474')
+NEO4J_USER = os.environ.get('NEO4J_USER', 'neo4j')
+NEO4J_PASSWORD = os.environ.get('NEO4J_PASSWORD', '12345678')
+NEO4J_DATABASE = os.environ.get('NEO4J_DATABASE', 'neo4j')
+NEO4J_POOL_SIZE = int(os.environ.get('NEO4J_POOL_SIZE', '16'))
+# 图存储的 uri：默认是 Neo4j，写成 sqlite:///path.db 时使用嵌入式的 SQLite 后端
+GRAPH_DB_URI = os.environ.get('GRAPH_DB_URI', NEO4J_URI)
+
+# 同一进程里连同一个库、连接池大小相同的 handler 共用 Graph 对象，也就共用它的连接池
+_graph_cache = {}
+_graph_cache_lock = threading.Lock()
+
+# stream_query / iter_task_nodes 每页的记录数
+STREAM_PAGE_SIZE = 1000
+
+# 多版本存储中还有效的节点 / 边的 valid_to
+OPEN_VERSION = 2 ** 62
+
+# 已经建好索引的 (uri, task_id)，避免每个 handler 都重复发送 DDL
+_schema_ready = set()
+# (uri, 任务) -> 版本区间存储是否建成了 (full_name, valid_to) 唯一约束
+_versioned_unique = {}
+
+# 项目里实际会跑的查询（queries.QUERIES 里的模板名 -> 参数），用于 schema_usage_report 检查是否命中索引
+SCHEMA_PROBE_QUERIES = {
+    'match_node': {'full_name': ''},
+    'module_member_by_name': {'module': '', 'name': ''},
+    'module_members': {'module': ''},
+    'class_methods': {'full_name': ''},
+    'class_by_name': {'name': ''},
+}
 
 class NoOpLock:
     def __enter__(self):
@@ -34,21 +75,56 @@ class FileLock:
 
 
 class GraphDatabaseHandler:
-    def __init__(self, uri, user, password, database_name='neo4j', task_id='', use_lock=False, lockfile='neo4j.lock'):
-        self.graph = self._connect_to_graph(uri, user, password, database_name)
-        self.node_matcher = NodeMatcher(self.graph)
-        self.rel_matcher = RelationshipMatcher(self.graph)
-        self.none_label = 'none'
+    def __init__(self, uri, user, password, database_name='neo4j', task_id='', use_lock=False, lockfile='neo4j.lock',
+                 batch_size=0, pool_size=NEO4J_POOL_SIZE, ensure_schema=True, max_retries=5, retry_delay=0.05,
+                 result_cache=None):
+        """
+        :param uri: http(s):// 走 HTTP API；bolt:// 或 neo4j:// 走 Bolt 协议，使用有上限的连接池
+        :param batch_size: 大于 0 时开启缓冲写入：add_node / add_edge 先放进内存，
+            攒够 batch_size 条、调用 flush() 或退出 with 时再用 UNWIND ... MERGE 批量写入
+        :param pool_size: 连接池最多保持的连接数
+        :param ensure_schema: 打开任务时创建 (task, full_name) 唯一约束和 name 索引
+        :param max_retries: 写入遇到死锁等瞬时错误时的最大重试次数
+        :param result_cache: execute_query 的结果缓存，True 表示用进程内共用的缓存，也可以传入 QueryResultCache
+        """
+        self.uri = uri
+        # 结果缓存和失效按 (uri, database) 区分，不同库里的同名任务互不影响
+        self.cache_store = (uri, database_name)
+        self.pool_size = pool_size
+        self.graph = self._get_graph(uri, user, password, database_name)
+        self.none_label = NONE_LABEL
         self.task_id = task_id
+        # 写入靠 MERGE + 唯一约束保证幂等，默认不需要进程间锁；use_lock=True 时仍然串行化写入
         self.lock = FileLock(lockfile) if use_lock else NoOpLock()
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.node_buffer = {}
+        self.edge_buffer = {}
+        self.result_cache = shared_query_cache if result_cache is True else result_cache
+        if task_id and ensure_schema:
+            self.ensure_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def _get_graph(self, uri, user, password, database_name):
+        key = (uri, user, database_name, self.pool_size)
+        with _graph_cache_lock:
+            if key not in _graph_cache:
+                _graph_cache[key] = self._connect_to_graph(uri, user, password, database_name)
+            return _graph_cache[key]
 
     def _connect_to_graph(self, uri, user, password, database_name):
         try:
-            return Graph(uri, auth=(user, password), name=database_name)
+            return Graph(uri, auth=(user, password), name=database_name, max_size=self.pool_size)
         except Exception as e:
             self._start_neo4j()
             try:
-                return Graph(uri, auth=(user, password), name=database_name)
+                return Graph(uri, auth=(user, password), name=database_name, max_size=self.pool_size)
             except Exception as e:
                 raise ConnectionError(
                     "Failed to connect to Neo4j at {} after attempting to start the service.".format(uri)) from e
@@ -62,121 +138,602 @@ class GraphDatabaseHandler:
         except subprocess.CalledProcessError as e:
             raise RuntimeError("Failed to start Neo4j service.") from e
 
-    def _match_node(self, full_name):
-        if self.task_id:
-            existing_node = self.node_matcher.match(self.task_id, full_name=full_name).first()
-        else:
-            existing_node = self.node_matcher.match(full_name=full_name).first()
-        return existing_node
-
-    def _create_node(self, label=None, full_name='', parms={}):
+    def ensure_schema(self, task_id=None):
+        """
+        幂等地创建索引：任务标签上 full_name 唯一约束和 name 索引，类型标签上 full_name / name 索引。
+        使用 IF NOT EXISTS / REQUIRE 语法，需要 Neo4j 4.4 及以上
+        """
+        task_id = task_id or self.task_id
+        if (self.uri, task_id) in _schema_ready:
+            return
+        if task_id:
+            try:
+                self._run_write(render('create_unique_full_name', label=task_id))
+            except Exception as e:
+                # 已有重复的 full_name 时无法建唯一约束，退而建普通索引；认证失败、版本不支持等其他错误直接抛出
+                if not _is_constraint_creation_error(e):
+                    raise
+                print('WARNING: unable to create unique constraint on `{0}`.full_name ({1}), '
+                      'creating an index instead'.format(task_id, e))
+                self._run_write(render('create_index_full_name', label=task_id))
+            self._run_write(render('create_index_name', label=task_id))
+        for label in KIND_LABELS:
+            self._run_write(render('create_index_full_name', label=label))
+            self._run_write(render('create_index_name', label=label))
+        _schema_ready.add((self.uri, task_id))
+
+    def schema_usage_report(self, queries=None):
+        """
+        对项目自己的查询做 EXPLAIN，返回每条查询的计划里用到了哪些索引算子
+        :return: [{'name', 'query', 'index_operators', 'uses_index'}]
+        """
+        if queries is None:
+            queries = SCHEMA_PROBE_QUERIES
+        report = []
+        for name, params in queries.items():
+            query = render(name, task=self.task_id)
+            try:
+                plan = self.graph.run("EXPLAIN " + query, **params).plan()
+                operators = _collect_plan_operators(plan)
+            except Exception as e:
+                report.append({'name': name, 'query': query, 'index_operators': [], 'uses_index': False,
+                               'error': str(e)})
+                continue
+            index_operators = [op for op in operators if 'Index' in op]
+            report.append({'name': name, 'query': query, 'index_operators': index_operators,
+                           'uses_index': len(index_operators) > 0})
+        return report
+
+    def _queue_node(self, label, full_name, parms):
         if label is None or label == '':
             label = self.none_label
-        if self.task_id:
-            node = Node(self.task_id, label, full_name=full_name, **parms)
+        row = self.node_buffer.get(full_name)
+        if row is None:
+            self.node_buffer[full_name] = {'label': label, 'full_name': full_name, 'parms': dict(parms)}
         else:
-            node = Node(label, full_name=full_name, **parms)
-        self.graph.create(node)
-        return node
-
-    def _update_node_label(self, full_name, label):
-        existing_node = self._match_node(full_name)
-        if existing_node:
-            query = (
-                "MATCH (n:{0} {{full_name: $full_name}}) "
-                "REMOVE n:{0} "
-                "SET n:{1}"
-            ).format(self.none_label, label)
-            self.graph.run(query, full_name=full_name)
-            return True
-        return False
+            # 和 add_node 一致：只有占位的 none 标签会被替换
+            if row['label'] == self.none_label:
+                row['label'] = label
+            row['parms'].update(parms)
+
+    def _queue_edge(self, start_label, start_name, relationship_type, end_label, end_name, params):
+        key = (start_name, relationship_type, end_name)
+        row = self.edge_buffer.get(key)
+        if row is None:
+            self.edge_buffer[key] = {
+                'start_label': start_label or self.none_label,
+                'start_name': start_name,
+                'relationship_type': relationship_type,
+                'end_label': end_label or self.none_label,
+                'end_name': end_name,
+                'params': dict(params),
+            }
+        else:
+            row['params'].update(params)
+
+    def _queue_is_full(self):
+        return len(self.node_buffer) + len(self.edge_buffer) >= self.batch_size
+
+    def _chunks(self, rows):
+        size = self.batch_size or len(rows) or 1
+        for start in range(0, len(rows), size):
+            yield rows[start:start + size]
+
+    def _run_write(self, query, **params):
+        """
+        执行写语句。MERGE 是幂等的，遇到死锁等瞬时错误时退避后重试，不需要全局锁
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.lock:
+                    cursor = self.graph.run(query, **params)
+                invalidate_task(self.task_id, self.cache_store)
+                return cursor
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_transient_error(e):
+                    raise
+                time.sleep(self.retry_delay * (2 ** attempt) * (0.5 + random.random()))
+
+    def _write_node_rows(self, rows, returning=False):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row['label'], []).append({'full_name': row['full_name'], 'parms': row['parms']})
+        results = []
+        for label, group in groups.items():
+            query = render('merge_nodes', task=self.task_id, label=label, none=self.none_label)
+            if returning:
+                query += " RETURN n"
+            for chunk in self._chunks(group):
+                cursor = self._run_write(query, rows=chunk)
+                if returning:
+                    results.extend(record['n'] for record in cursor)
+        return results
+
+    def _write_edge_rows(self, rows, returning=False):
+        results = []
+        groups = {}
+        for row in rows:
+            key = (row['start_label'], row['relationship_type'], row['end_label'])
+            groups.setdefault(key, []).append({'start_name': row['start_name'],
+                                               'end_name': row['end_name'],
+                                               'params': row['params']})
+        for (start_label, relationship_type, end_label), group in groups.items():
+            query = render('merge_edges', task=self.task_id, start_label=start_label, rel=relationship_type,
+                           end_label=end_label)
+            if returning:
+                query += " RETURN r"
+            for chunk in self._chunks(group):
+                cursor = self._run_write(query, rows=chunk)
+                if returning:
+                    results.extend(record['r'] for record in cursor)
+        return results
+
+    def flush(self):
+        """
+        把缓冲的节点和边写入数据库；节点先写，这样边的端点能拿到正确的标签
+        """
+        if not self.node_buffer and not self.edge_buffer:
+            return
+        node_rows = list(self.node_buffer.values())
+        edge_rows = list(self.edge_buffer.values())
+        self.node_buffer = {}
+        self.edge_buffer = {}
+        self._write_node_rows(node_rows)
+        self._write_edge_rows(edge_rows)
 
     def clear_task_data(self, task_id):
         """
         Delete all nodes with the specified label.
         """
-        query = "MATCH (n:`{label}`) DETACH DELETE n".format(label=task_id)
-        with self.lock:
-            self.graph.run(query)
+        if not task_id:
+            # 空的任务标签会匹配所有节点，清空整个库请用 clear_database
+            raise ValueError('clear_task_data needs a task id')
+        if task_id == self.task_id:
+            self.node_buffer = {}
+            self.edge_buffer = {}
+        self._run_write(render('clear_task', task=task_id))
+        invalidate_task(task_id, self.cache_store)
 
     def clear_database(self):
-        with self.lock:
-            self.graph.run("MATCH (n) DETACH DELETE n")
-
-    def execute_query(self, query):
+        self.node_buffer = {}
+        self.edge_buffer = {}
+        self._run_write(render('clear_database'))
+        invalidate_task(store=self.cache_store)
+
+    def execute_query(self, query, params=None):
+        # 只读查询不加锁
+        self.flush()
         try:
-            with self.lock:
-                result = self.graph.run(query)
-                return [record for record in result]
+            return self._cached_query(query, params,
+                                      lambda: [record for record in self.graph.run(query, **(params or {}))])
         except:
             return ''
 
+    def stream_query(self, query, params=None, page_size=STREAM_PAGE_SIZE):
+        """
+        逐条 yield 记录，不把整个结果放进内存（Bolt 下由驱动按批从服务端拉取）；
+        和 execute_query 不同，出错时直接抛出异常，也不经过结果缓存
+        """
+        self.flush()
+        cursor = self.graph.run(query, **(params or {}))
+        if is_write_query(query):
+            invalidate_task(self.task_id, self.cache_store)
+        while True:
+            page = list(itertools.islice(cursor, page_size))
+            if not page:
+                return
+            for record in page:
+                yield record
+
+    def iter_task_nodes(self, page_size=STREAM_PAGE_SIZE):
+        """
+        按 full_name 分页（每页一次独立的查询，走 full_name 索引）取出任务里的所有节点，
+        任何传输方式下内存占用都只有一页
+        """
+        query, params = self._task_nodes_page_query()
+        after = ''
+        while True:
+            params.update(after=after, page_size=page_size)
+            page = [record['n'] for record in self.stream_query(query, params)]
+            for node in page:
+                yield node
+            if len(page) < page_size:
+                return
+            after = page[-1]['full_name']
+
+    def _task_nodes_page_query(self):
+        return render('task_nodes_page', task=self.task_id), {}
+
+    def _cached_query(self, query, params, run):
+        """
+        开启 result_cache 时先查缓存；写语句不缓存，执行后让任务的缓存失效
+        :param run: 真正执行查询、返回记录列表的函数
+        """
+        if is_write_query(query):
+            result = run()
+            invalidate_task(self.task_id, self.cache_store)
+            return result
+        if self.result_cache is None:
+            return run()
+        found, result = self.result_cache.get(self.cache_store, self.task_id, query, params)
+        if found:
+            return result
+        generation = self.result_cache.generation(self.cache_store, self.task_id)
+        result = run()
+        self.result_cache.put(self.cache_store, self.task_id, query, params, result, generation)
+        return result
+
+    def add_task_label(self, source_task, target_task, exclude_files=(), batch_size=10000):
+        """
+        给 source_task 中 file_path 不在 exclude_files 里的节点加上 target_task 标签。
+        在服务端分批执行，每批最多 batch_size 个节点，结果不拉回客户端
+        :return: 加上标签的节点数
+        """
+        self.flush()
+        query = render('add_task_label', task=source_task, target=target_task)
+        exclude_files = list(set(exclude_files))
+        total = 0
+        while True:
+            cursor = self._run_write(query, exclude_files=exclude_files, batch_size=batch_size)
+            relabelled = cursor.evaluate() or 0
+            invalidate_task(target_task, self.cache_store)
+            total += relabelled
+            print('Relabelled {0} nodes `{1}` -> `{2}`'.format(total, source_task, target_task))
+            if relabelled < batch_size:
+                return total
+
+    def get_indexed_files(self):
+        """
+        :return: {file_path: (content_hash, indexer_version)}，来自记录了 content_hash 的 MODULE 节点
+        """
+        response = self.execute_query(render('indexed_files', task=self.task_id))
+        return {record['file_path']: (record['content_hash'], record['indexer_version']) for record in response or []}
+
+    def delete_file_nodes(self, file_paths):
+        """
+        删除属于这些文件的节点以及它们的边
+        """
+        self.flush()
+        query = render('delete_file_nodes', task=self.task_id)
+        for chunk in self._chunks(list(file_paths)):
+            self._run_write(query, file_paths=chunk)
+
+    def get_module_contains(self):
+        """
+        一次查询取出任务里所有 MODULE -[:CONTAINS]-> 节点，逐条 yield (module, name, full_name, 类型标签)
+        """
+        self.flush()
+        for record in self.graph.run(render('module_contains', task=self.task_id)):
+            label = _kind_label(record['labels'])
+            if label:
+                yield record['module'], record['name'], record['full_name'], label
+
+    def get_relations(self, relationship_type, with_params=False):
+        """
+        一次查询取出任务里某种关系的所有边，逐条 yield (起点 full_name, 终点 full_name)
+        :param with_params: 为 True 时 yield (起点, 终点, 边的属性)
+        """
+        self.flush()
+        for record in self.graph.run(render('relations', task=self.task_id, rel=relationship_type)):
+            if with_params:
+                yield record['start_name'], record['end_name'], dict(record['params'] or {})
+            else:
+                yield record['start_name'], record['end_name']
+
+    def delete_relations(self, relationship_type, start_names, flag):
+        """
+        删除从这些节点出发、属性 flag 为 true 的某种关系（例如 inherited 标记的 HAS_METHOD）
+        """
+        self.flush()
+        query = render('delete_flagged_relations', task=self.task_id, rel=relationship_type)
+        for chunk in self._chunks(list(start_names)):
+            self._run_write(query, start_names=chunk, flag=flag)
+
+    def get_member_of_module(self, module_full_name, name):
+        """
+        MODULE -[:CONTAINS]-> 名为 name 的节点
+        :return: (full_name, 类型标签)，找不到时返回 (None, None)
+        """
+        response = self.execute_query(render('module_member_by_name', task=self.task_id),
+                                      {'module': module_full_name, 'name': name})
+        if response:
+            label = _kind_label(response[0]['labels'])
+            if label:
+                return response[0]['full_name'], label
+        return None, None
+
+    def get_members_of_module(self, module_full_name):
+        """
+        :return: [[full_name, 类型标签], ...]
+        """
+        response = self.execute_query(render('module_members', task=self.task_id), {'module': module_full_name})
+        members = [[record['full_name'], _kind_label(record['labels'])] for record in response or []]
+        return [member for member in members if member[1]]
+
+    def get_methods_of_class(self, class_full_name):
+        response = self.execute_query(render('class_methods', task=self.task_id), {'full_name': class_full_name})
+        return [record['full_name'] for record in response or []]
+
     def update_node(self, full_name, parms={}):
-        with self.lock:
-            existing_node = self._match_node(full_name)
-            if existing_node:
-                existing_node.update(parms)
-                self.graph.push(existing_node)
+        self.flush()
+        self._run_write(render('update_node', task=self.task_id), full_name=full_name, parms=dict(parms))
 
     def add_node(self, label, full_name, parms={}):
-        with self.lock:
-            existing_node = self._match_node(full_name)
-            if existing_node:
-                if self.none_label in list(existing_node.labels):
-                    self._update_node_label(full_name, label)
-                existing_node.update(parms)
-                self.graph.push(existing_node)
-            else:
-                existing_node = self._create_node(label, full_name, parms=parms)
-            return existing_node
+        if self.batch_size:
+            self._queue_node(label, full_name, parms)
+            if self._queue_is_full():
+                self.flush()
+            return None
+        nodes = self._write_node_rows([{'label': label or self.none_label, 'full_name': full_name,
+                                        'parms': dict(parms)}], returning=True)
+        return nodes[0] if nodes else None
 
     def add_edge(self, start_label=None, start_name='', relationship_type='', end_label=None, end_name='', params={}):
-        with self.lock:
-            start_node = self._match_node(full_name=start_name)
-            end_node = self._match_node(full_name=end_name)
-
-            if not start_node:
-                start_node = self._create_node(start_label, full_name=start_name, parms=params)
-            if not end_node:
-                end_node = self._create_node(end_label, full_name=end_name, parms=params)
-
-            if start_node and end_node:
-                rel = self.rel_matcher.match((start_node, end_node), relationship_type).first()
-                if rel:
-                    rel.update(params)
-                    self.graph.push(rel)
-                    return rel
-                else:
-                    rel = Relationship(start_node, relationship_type, end_node, **params)
-                    self.graph.create(rel)
-                    return rel
-            return None
+        if self.batch_size:
+            # 缓冲模式下没有 Relationship 对象可返回，返回 True 表示已排队
+            self._queue_edge(start_label, start_name, relationship_type, end_label, end_name, params)
+            if self._queue_is_full():
+                self.flush()
+            return True
+        rels = self._write_edge_rows([{
+            'start_label': start_label or self.none_label,
+            'start_name': start_name,
+            'relationship_type': relationship_type,
+            'end_label': end_label or self.none_label,
+            'end_name': end_name,
+            'params': dict(params),
+        }], returning=True)
+        return rels[0] if rels else None
 
     def update_file_path(self, root_path):
-        with self.lock:
-            # 获取所有包含 file_path 属性的节点
-            query = (
-                "MATCH (n:`{0}`) "
-                "WHERE exists(n.file_path)"
-                "RETURN n.file_path as file_path, n.full_name as full_name"
-            ).format(self.task_id)
-
-            nodes_with_file_path = self.execute_query(query)
-            # 遍历每个节点并更新 file_path
-            for node in nodes_with_file_path:
-                full_name = node['full_name']
-                file_path = node['file_path']
-                # old_path = node['file_path']
-                if file_path.startswith(root_path):
-                    file_path = file_path[len(root_path):]
-                    self.update_node(full_name=full_name, parms={
-                        "file_path": file_path
-                    })
+        # 逐条取出包含 file_path 属性的节点
+        nodes_with_file_path = self.stream_query(render('nodes_with_file_path', task=self.task_id))
+        # 遍历每个节点并更新 file_path
+        for node in nodes_with_file_path:
+            full_name = node['full_name']
+            file_path = node['file_path']
+            # old_path = node['file_path']
+            if file_path.startswith(root_path):
+                file_path = file_path[len(root_path):]
+                self.update_node(full_name=full_name, parms={
+                    "file_path": file_path
+                })
+
+def _kind_label(labels):
+    return next((label for label in labels if label in KIND_LABELS), None)
+
+
+def _is_constraint_creation_error(error):
+    """
+    已有数据违反约束（例如重复的 full_name）导致建约束失败
+    """
+    text = '{0} {1} {2}'.format(type(error).__name__, getattr(error, 'code', ''), error)
+    return any(token in text for token in ('ConstraintCreationFailed', 'ConstraintValidationFailed',
+                                           'Unable to create Constraint'))
+
+
+def _is_constraint_unavailable_error(error):
+    """
+    建不了复合约束：已有数据违反约束，或者服务端不支持（NODE KEY 需要企业版，4.x 的 UNIQUE 不支持多个属性）
+    """
+    text = '{0} {1} {2}'.format(type(error).__name__, getattr(error, 'code', ''), error)
+    return _is_constraint_creation_error(error) or any(
+        token in text for token in ('Enterprise Edition', 'SyntaxError', 'does not allow multiple properties',
+                                    'Unsupported'))
+
+
+def _is_transient_error(error):
+    """
+    死锁、锁等待超时以及并发 MERGE 撞上唯一约束都可以直接重试
+    """
+    text = '{0} {1} {2}'.format(type(error).__name__, getattr(error, 'code', ''), error)
+    return any(token in text for token in ('TransientError', 'DeadlockDetected', 'LockClient',
+                                           'ConstraintValidationFailed'))
+
+
+def _collect_plan_operators(plan):
+    """
+    按深度优先收集执行计划里的算子名，兼容 py2neo 返回的对象和字典两种形式
+    """
+    if plan is None:
+        return []
+    if isinstance(plan, dict):
+        operator = plan.get('operator_type') or plan.get('operatorType', '')
+        children = plan.get('children', [])
+    else:
+        operator = getattr(plan, 'operator_type', '')
+        children = getattr(plan, 'children', [])
+    # 新版本的算子名带 @neo4j 之类的后缀
+    operators = [str(operator).split('@')[0]]
+    for child in children:
+        operators.extend(_collect_plan_operators(child))
+    return operators
+
+
+class VersionedGraphDatabaseHandler(GraphDatabaseHandler):
+    """
+    多版本存储：一个任务标签下保存所有版本，节点和边带 [valid_from, valid_to) 版本区间，
+    还有效的节点 valid_to = OPEN_VERSION。新版本只关闭改动文件的节点和边、写入新节点，
+    未改动的节点在版本之间共用，存储量约等于各版本改动的并集
+    """
+    def __init__(self, uri, user, password, database_name='neo4j', task_id='', version=0, **kwargs):
+        """
+        :param version: 写入的版本号，单调递增的整数（例如 commit 序号）
+        """
+        self.version = version
+        super().__init__(uri, user, password, database_name=database_name, task_id=task_id, **kwargs)
+
+    def ensure_schema(self, task_id=None):
+        """
+        同一个 full_name 会有多个版本，不能对 full_name 建唯一约束；改为 (full_name, valid_to) 上的唯一约束
+        (NODE KEY 需要企业版，复合 UNIQUE 需要 Neo4j 5)，保证并发的 worker 不会 MERGE 出两个还有效的同名节点。
+        两种约束都建不了时退回复合索引，并用进程间文件锁串行化这个任务的写入
+        """
+        task_id = task_id or self.task_id
+        if (self.uri, task_id, 'versioned') in _schema_ready:
+            if not _versioned_unique.get((self.uri, task_id), True):
+                self._serialize_writes(task_id)
+            return
+        if task_id:
+            unique = False
+            for name in ('create_node_key_full_name_valid_to', 'create_unique_full_name_valid_to'):
+                try:
+                    self._run_write(render(name, label=task_id))
+                    unique = True
+                    break
+                except Exception as e:
+                    # 认证失败、连不上等其他错误直接抛出，不当作“不支持唯一约束”
+                    if not _is_constraint_unavailable_error(e):
+                        raise
+                    error = e
+            if not unique:
+                print('WARNING: unable to create a (full_name, valid_to) constraint on `{0}` ({1}), '
+                      'serializing versioned writes instead'.format(task_id, error))
+                self._run_write(render('create_index_full_name_valid_to', label=task_id))
+                self._serialize_writes(task_id)
+            _versioned_unique[(self.uri, task_id)] = unique
+            self._run_write(render('create_index_validity', label=task_id))
+            self._run_write(render('create_index_name', label=task_id))
+            self._run_write(render('create_index_file_path', label=task_id))
+        for label in KIND_LABELS:
+            self._run_write(render('create_index_full_name_valid_to', label=label))
+            self._run_write(render('create_index_name', label=label))
+        _schema_ready.add((self.uri, task_id, 'versioned'))
+
+    def _serialize_writes(self, task_id):
+        # 同一台机器上所有写这个任务的进程共用一把锁
+        self.lock = FileLock(os.path.join(tempfile.gettempdir(),
+                                          'code_graph_{0}.lock'.format(task_id.replace('/', '_'))))
+
+    def _write_node_rows(self, rows, returning=False):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row['label'], []).append({'full_name': row['full_name'], 'parms': row['parms']})
+        results = []
+        for label, group in groups.items():
+            query = render('versioned_merge_nodes', task=self.task_id, label=label, none=self.none_label)
+            if returning:
+                query += " RETURN n"
+            for chunk in self._chunks(group):
+                cursor = self._run_write(query, rows=chunk, open=OPEN_VERSION, version=self.version)
+                if returning:
+                    results.extend(record['n'] for record in cursor)
+        return results
+
+    def _write_edge_rows(self, rows, returning=False):
+        results = []
+        groups = {}
+        for row in rows:
+            key = (row['start_label'], row['relationship_type'], row['end_label'])
+            groups.setdefault(key, []).append({'start_name': row['start_name'],
+                                               'end_name': row['end_name'],
+                                               'params': row['params']})
+        for (start_label, relationship_type, end_label), group in groups.items():
+            query = render('versioned_merge_edges', task=self.task_id, start_label=start_label,
+                           rel=relationship_type, end_label=end_label)
+            if returning:
+                query += " RETURN r"
+            for chunk in self._chunks(group):
+                cursor = self._run_write(query, rows=chunk, open=OPEN_VERSION, version=self.version)
+                if returning:
+                    results.extend(record['r'] for record in cursor)
+        return results
+
+    def update_node(self, full_name, parms={}):
+        self.flush()
+        self._run_write(render('versioned_update_node', task=self.task_id), full_name=full_name, parms=dict(parms),
+                        open=OPEN_VERSION)
+
+    def begin_version(self, file_paths, batch_size=10000):
+        """
+        开始写 self.version：关闭这些文件当前有效的节点以及和它们相连的边（valid_to = version），
+        之后重新索引这些文件会建出 valid_from = version 的新节点
+        :return: 关闭的节点数
+        """
+        self.flush()
+        query = render('versioned_close_files', task=self.task_id)
+        file_paths = list(set(file_paths))
+        total = 0
+        while True:
+            cursor = self._run_write(query, file_paths=file_paths, batch_size=batch_size,
+                                     open=OPEN_VERSION, version=self.version)
+            closed = cursor.evaluate() or 0
+            total += closed
+            if closed < batch_size:
+                print('Closed {0} nodes at version {1}'.format(total, self.version))
+                return total
+
+    def delete_file_nodes(self, file_paths):
+        # 旧版本还要用这些节点，只关闭不删除
+        self.begin_version(file_paths)
+
+    def execute_at_version(self, query, version=None, params=None):
+        """
+        执行用 version_filter 写的查询，$version 默认是 self.version
+        """
+        params = dict(params or {})
+        params['version'] = self.version if version is None else version
+        return self.execute_query(query, params)
+
+    def _task_nodes_page_query(self):
+        # 只取 self.version 时有效的节点
+        return render('versioned_task_nodes_page', task=self.task_id), {'version': self.version}
+
+    def get_indexed_files(self):
+        response = self.execute_query(render('versioned_indexed_files', task=self.task_id), {'open': OPEN_VERSION})
+        return {record['file_path']: (record['content_hash'], record['indexer_version']) for record in response or []}
+
+    def get_module_contains(self):
+        self.flush()
+        for record in self.graph.run(render('versioned_module_contains', task=self.task_id), version=self.version):
+            label = _kind_label(record['labels'])
+            if label:
+                yield record['module'], record['name'], record['full_name'], label
+
+    def get_relations(self, relationship_type, with_params=False):
+        self.flush()
+        query = render('versioned_relations', task=self.task_id, rel=relationship_type)
+        for record in self.graph.run(query, version=self.version):
+            if with_params:
+                yield record['start_name'], record['end_name'], dict(record['params'] or {})
+            else:
+                yield record['start_name'], record['end_name']
+
+    def delete_relations(self, relationship_type, start_names, flag):
+        # 旧版本还要用这些边，只关闭不删除
+        self.flush()
+        query = render('versioned_close_flagged_relations', task=self.task_id, rel=relationship_type)
+        for chunk in self._chunks(list(start_names)):
+            self._run_write(query, start_names=chunk, flag=flag, open=OPEN_VERSION, version=self.version)
+
+    def get_member_of_module(self, module_full_name, name):
+        response = self.execute_at_version(render('versioned_module_member_by_name', task=self.task_id),
+                                           params={'module': module_full_name, 'name': name})
+        if response:
+            label = _kind_label(response[0]['labels'])
+            if label:
+                return response[0]['full_name'], label
+        return None, None
+
+    def get_members_of_module(self, module_full_name):
+        response = self.execute_at_version(render('versioned_module_members', task=self.task_id),
+                                           params={'module': module_full_name})
+        members = [[record['full_name'], _kind_label(record['labels'])] for record in response or []]
+        return [member for member in members if member[1]]
+
+    def get_methods_of_class(self, class_full_name):
+        response = self.execute_at_version(render('versioned_class_methods', task=self.task_id),
+                                           params={'full_name': class_full_name})
+        return [record['full_name'] for record in response or []]
+
 
 class GraphDatabaseHandlerNone():
     def __init__(self, *args, **params):
         pass
 
+    def flush(self):
+        pass
+
     def add_node(self, label, full_name, parms={}):
         pass
 
@@ -184,23 +741,33 @@ class GraphDatabaseHandlerNone():
         pass
 
 
+def create_graph_handler(uri=None, user=NEO4J_USER, password=NEO4J_PASSWORD, database_name=NEO4J_DATABASE,
+                         task_id='', version=None, **kwargs):
+    """
+    按 uri 的 scheme 选择后端：sqlite:// 用嵌入式的 SqliteGraphDatabaseHandler，其余用 Neo4j
+    :param uri: 默认取 GRAPH_DB_URI
+    :param version: 不为 None 时使用版本区间存储 (VersionedGraphDatabaseHandler)，目前只支持 Neo4j
+    """
+    uri = uri or GRAPH_DB_URI
+    if urlparse(uri).scheme == 'sqlite':
+        if version is not None:
+            raise ValueError('Versioned storage is only supported on Neo4j: {}'.format(uri))
+        from graph_database_index.sqliteDB import SqliteGraphDatabaseHandler
+        return SqliteGraphDatabaseHandler(uri, task_id=task_id, **kwargs)
+    if version is not None:
+        return VersionedGraphDatabaseHandler(uri=uri, user=user, password=password, database_name=database_name,
+                                             task_id=task_id, version=version, **kwargs)
+    return GraphDatabaseHandler(uri=uri, user=user, password=password, database_name=database_name,
+                                task_id=task_id, **kwargs)
+
+
 def clear_task(task_id):
-    graphDB = GraphDatabaseHandler(uri="http://localhost:7474",
-                                   user="neo4j",
-                                   password="12345678",
-                                   database_name='neo4j',
-                                   task_id=task_id,
-                                   use_lock=True)
+    graphDB = create_graph_handler(task_id=task_id)
     graphDB.clear_task_data(task_id)
 
 
 def update_file_path(task_id, root_path):
-    graphDB = GraphDatabaseHandler(uri="http://localhost:7474",
-                                   user="neo4j",
-                                   password="12345678",
-                                   database_name='neo4j',
-                                   task_id=task_id,
-                                   use_lock=True)
+    graphDB = create_graph_handler(task_id=task_id)
 
     graphDB.update_file_path(root_path)
 
@@ -209,10 +776,8 @@ def extract_code_from_file(file_path, start_line, end_line, is_indent=True):
     if start_line < 1:
         start_line = 1
     try:
-        with codecs.open(file_path, 'r', encoding='utf-8') as input:
-            sourceCode = input.read()
-        source_code_lines = sourceCode.split('\n')
-        extracted_lines = source_code_lines[start_line - 1:end_line]
+        # 切片在 code_cache 的锁里完成，不会碰到被别的线程淘汰、已经关闭的 mmap
+        extracted_lines = code_cache.lines(file_path, start_line, end_line)
     except:
         return ''
     # 去除指定数量的缩进
@@ -256,16 +821,38 @@ def process_string(input_string, repo_path, folded_len=10, is_indent=False):
 
     return input_string
 
+def hydrate_code(records, repo_path, is_indent=False):
+    """
+    批量取出节点的代码：按 code_file 分组依次读取，每个文件在 code_cache 里只加载一次
+    :param records: 带 start_line / end_line / code_file 属性的节点（或 dict）列表
+    :param repo_path: repo根目录，相对路径的 code_file 拼在它下面，绝对路径原样使用
+    :param is_indent: 是否去除缩进，False是保留缩进
+    :return: 和 records 一一对应的代码，没有代码位置的节点为 None
+    """
+    by_file = {}
+    for i, record in enumerate(records):
+        code_file = record.get('code_file')
+        if code_file is None or record.get('start_line') is None:
+            continue
+        by_file.setdefault(code_file, []).append(i)
+
+    codes = [None] * len(records)
+    for code_file, indices in by_file.items():
+        file_path = os.path.join(repo_path, code_file) if repo_path and not os.path.isabs(code_file) else code_file
+        for i in indices:
+            codes[i] = extract_code_from_file(file_path, int(records[i]['start_line']), int(records[i]['end_line']),
+                                              is_indent=is_indent)
+    return codes
+
 if __name__ == '__main__':
     # task_label = "project_cc_python/102"
     repo_path = r'/home/lanbo/repo/test_repo'
     task_label = 'sklearn'
-    graph_db = GraphDatabaseHandler(uri="http://localhost:7474",
-                                    user="neo4j",
-                                    password="12345678",
-                                    database_name='neo4j',
-                                    task_id=task_label,
-                                    use_lock=True)
+    graph_db = GraphDatabaseHandler(uri=NEO4J_URI,
+                                    user=NEO4J_USER,
+                                    password=NEO4J_PASSWORD,
+                                    database_name=NEO4J_DATABASE,
+                                    task_id=task_label)
     user_query = """
     MATCH (c:`sklearn`:CLASS {name: 'Person'})
     RETURN c
@@ -0,0 +1,73 @@
+"""
+增量索引：每个文件的 MODULE 节点上记录 content_hash 和 indexer_version，
+再次索引前先和工作区比较，只索引新增 / 改动的文件，删除已经不存在的文件的节点
+"""
+import os
+import hashlib
+
+# 索引器输出格式变化时加一，旧版本写入的文件会被全部重新索引
+INDEXER_VERSION = '3'
+
+
+def file_content_hash(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def relative_file_path(file_path, root_path):
+    """
+    和 AstVisitorClient.process_file_path 一致，得到节点里保存的 file_path
+    """
+    file_path = file_path.replace('\\', '/')
+    if root_path and file_path.startswith(root_path):
+        file_path = file_path[len(root_path):]
+    return file_path
+
+
+def plan_reindex(graph_db, file_list, root_path):
+    """
+    :return: (需要索引的文件列表, 已删除文件在图里的 file_path 列表, 未改动的文件数,
+        需要索引的文件中以前索引过（内容或索引器版本变了）的文件列表)
+    """
+    indexed = graph_db.get_indexed_files()
+    to_index = []
+    changed = []
+    current = set()
+    unchanged = 0
+    for file_path in file_list:
+        relative_path = relative_file_path(file_path, root_path)
+        current.add(relative_path)
+        if indexed.get(relative_path) == (file_content_hash(file_path), INDEXER_VERSION):
+            unchanged += 1
+        else:
+            to_index.append(file_path)
+            if relative_path in indexed:
+                changed.append(file_path)
+    deleted = [file_path for file_path in indexed.keys() if file_path not in current]
+    return to_index, deleted, unchanged, changed
+
+
+def prepare_incremental_index(graph_db, file_list, root_path, dependency_index=None):
+    """
+    删除改动文件和已删除文件的旧节点（版本区间存储下是在新版本关闭它们），返回还需要索引的文件。
+    MERGE 只会新增和更新，不先删除的话改动文件里删掉的函数、类和边会一直留在图里
+    :param dependency_index: 传入时 import 了改动 / 删除文件的文件也重新索引，
+        它们指向旧节点的边随旧节点一起被删除了
+    """
+    to_index, deleted, unchanged, changed = plan_reindex(graph_db, file_list, root_path)
+    purge = [relative_file_path(file_path, root_path) for file_path in changed] + deleted
+    if purge:
+        graph_db.delete_file_nodes(purge)
+    dependents = []
+    if dependency_index is not None and purge:
+        to_index_set = set(to_index)
+        for path in dependency_index.dependents([path.lstrip('/\\') for path in purge]):
+            file_path = os.path.join(root_path, path)
+            if file_path not in to_index_set:
+                dependents.append(file_path)
+    print('Incremental index: {0} to index ({1} changed, {2} dependent), {3} unchanged, {4} deleted'.format(
+        len(to_index) + len(dependents), len(changed), len(dependents), unchanged, len(deleted)))
+    return to_index + dependents
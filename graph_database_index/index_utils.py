@@ -1,8 +1,15 @@
 
+import os
 import json
+import hashlib
 import jedi
+import parso
+from jedi import cache
+from jedi import settings
+from collections import OrderedDict
 from jedi.api import helpers
 from jedi.api import classes
+from jedi.inference import InferenceState
 from jedi.inference.gradual.conversion import convert_names
 
 _virtualFilePath = 'virtual_file.py'
@@ -10,8 +17,31 @@ _virtualFilePath = 'virtual_file.py'
 class SourcetrailScript(jedi.Script):
 	def __init__(self, source=None, line=None, column=None, path=None,
 				encoding='utf-8', sys_path=None, environment=None,
-				_project=None):
-		jedi.Script.__init__(self, source, line, column, path, encoding, sys_path, environment, _project)
+				_project=None, _inference_state=None):
+		if _inference_state is None:
+			jedi.Script.__init__(self, source, line, column, path, encoding, sys_path, environment, _project)
+			return
+		# same as jedi.Script.__init__, but parses with the shared InferenceState instead of building (and throwing
+		# away) a new one for every script: inferred modules and memoized results are shared by the whole ScriptCache
+		self._orig_path = path
+		self.path = os.path.abspath(path) if path else None
+		if source is None:
+			with open(path, 'rb') as f:
+				source = f.read()
+		self._inference_state = _inference_state
+		self._module_node, source = _inference_state.parse_and_get_code(
+			code=source,
+			path=self.path,
+			encoding=encoding,
+			use_latest_grammar=path and path.endswith('.pyi'),
+			cache=False,
+			diff_cache=settings.fast_parser,
+			cache_path=settings.cache_directory,
+		)
+		self._code_lines = parso.split_lines(source, keepends=True)
+		self._code = source
+		self._pos = line, column
+		cache.clear_time_caches()
 
 	def _goto(self, line, column, follow_imports=False, follow_builtin_imports=False,
 				only_stubs=False, prefer_stubs=False, follow_override=False):
@@ -37,6 +67,167 @@ class SourcetrailScript(jedi.Script):
 		defs = [classes.Name(self._inference_state, d) for d in set(names)]
 		return list(set(helpers.sorted_definitions(defs)))
 
+def getContentHash(content):
+	if isinstance(content, str):
+		content = content.encode('utf-8')
+	return hashlib.sha1(content).hexdigest()
+
+
+class ScriptCache:
+	"""
+	Caches one SourcetrailScript per file, keyed by file path and content hash, so that all definition lookups of a
+	visitor (and of every visitor in the same worker) reuse the parsed module and its module context. All scripts with
+	the same environment and sys path share one jedi InferenceState.
+	A file is re-read and re-hashed at most once per beginFile() call; the file being indexed is assumed not to
+	change while it is traversed. When a cached file turns out to have changed, the shared InferenceStates (which
+	may have inferred the old version of the module for other files) are dropped together with all scripts, and
+	generation is increased.
+	"""
+
+	def __init__(self, maxScripts = 256):
+		self.maxScripts = maxScripts
+		self.scripts = OrderedDict()
+		self.inferenceStates = {}
+		self.validatedPaths = set()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+
+	def beginFile(self):
+		self.validatedPaths.clear()
+
+	def clear(self):
+		self.scripts.clear()
+		self.inferenceStates.clear()
+		self.validatedPaths.clear()
+		self.generation += 1
+
+	def getContentHash(self, sourceFilePath):
+		if sourceFilePath in self.scripts:
+			return self.scripts[sourceFilePath][0]
+		return None
+
+	def getInferenceState(self, environment, sysPath):
+		key = (environment.path, tuple(sysPath))
+		if key not in self.inferenceStates:
+			projectPath = sysPath[0] if sysPath else None
+			project = jedi.api.project.Project(projectPath, environment_path=environment.path, sys_path=list(sysPath))
+			self.inferenceStates[key] = InferenceState(project, environment=environment, script_path=projectPath)
+		return self.inferenceStates[key]
+
+	def getScript(self, sourceFilePath, environment, sysPath, sourceFileContent = None):
+		if sourceFilePath in self.scripts and sourceFilePath in self.validatedPaths:
+			self.hits += 1
+			self.scripts.move_to_end(sourceFilePath)
+			return self.scripts[sourceFilePath][1]
+
+		if sourceFilePath == _virtualFilePath: # we are indexing a provided code snippet
+			source = sourceFileContent
+			path = None
+		else: # we are indexing a real file
+			with open(sourceFilePath, 'rb') as input:
+				source = input.read()
+			path = sourceFilePath
+		contentHash = getContentHash(source)
+		self.validatedPaths.add(sourceFilePath)
+
+		if sourceFilePath in self.scripts:
+			if self.scripts[sourceFilePath][0] == contentHash:
+				self.hits += 1
+				self.scripts.move_to_end(sourceFilePath)
+				return self.scripts[sourceFilePath][1]
+			# the file changed: every script and inference state may depend on its old content
+			self.clear()
+			self.validatedPaths.add(sourceFilePath)
+
+		self.misses += 1
+		script = SourcetrailScript(
+			source=source,
+			path=path,
+			environment=environment,
+			sys_path=sysPath,
+			_inference_state=self.getInferenceState(environment, sysPath)
+		)
+		self.scripts[sourceFilePath] = (contentHash, script)
+		self.scripts.move_to_end(sourceFilePath)
+		while len(self.scripts) > self.maxScripts:
+			self.scripts.popitem(last=False)
+		return script
+
+
+class ResolutionCache:
+	"""
+	Memoizes the definitions (goto results) and the computed NameHierarchy of name nodes, keyed by module path and
+	start_pos. The entries of a module are dropped as soon as its content hash changes. goto results also depend on
+	the other files of the repo, so everything is dropped when the ScriptCache generation changes (see useGeneration).
+	Stored name hierarchies are copied on the way in and out because callers extend them in place.
+	"""
+
+	_missing = object()
+
+	def __init__(self):
+		self.modules = {}
+		self.generation = None
+		self.hits = 0
+		self.misses = 0
+
+	def clear(self):
+		self.modules.clear()
+
+	def useGeneration(self, generation):
+		if generation != self.generation:
+			self.modules.clear()
+			self.generation = generation
+
+	def getModuleEntry(self, moduleKey, contentHash):
+		entry = self.modules.get(moduleKey)
+		if entry is None or entry['hash'] != contentHash:
+			entry = {'hash': contentHash, 'definitions': {}, 'nameHierarchies': {}}
+			self.modules[moduleKey] = entry
+		return entry
+
+	def lookup(self, table, moduleKey, contentHash, startPos):
+		value = self.getModuleEntry(moduleKey, contentHash)[table].get(startPos, self._missing)
+		if value is self._missing:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return value
+
+	def getDefinitions(self, moduleKey, contentHash, startPos):
+		definitions = self.lookup('definitions', moduleKey, contentHash, startPos)
+		if definitions is self._missing:
+			return None
+		return list(definitions)
+
+	def setDefinitions(self, moduleKey, contentHash, startPos, definitions):
+		self.getModuleEntry(moduleKey, contentHash)['definitions'][startPos] = list(definitions)
+
+	def getNameHierarchy(self, moduleKey, contentHash, startPos):
+		"""
+		returns (found, nameHierarchy); a cached None is a valid result
+		"""
+		nameHierarchy = self.lookup('nameHierarchies', moduleKey, contentHash, startPos)
+		if nameHierarchy is self._missing:
+			return False, None
+		if nameHierarchy is None:
+			return True, None
+		return True, nameHierarchy.copy()
+
+	def setNameHierarchy(self, moduleKey, contentHash, startPos, nameHierarchy):
+		if nameHierarchy is not None:
+			nameHierarchy = nameHierarchy.copy()
+		self.getModuleEntry(moduleKey, contentHash)['nameHierarchies'][startPos] = nameHierarchy
+
+	def getStatistics(self):
+		total = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_ratio': float(self.hits) / total if total else 0.0
+		}
+
+
 class ContextInfo:
 
 	def __init__(self, id, name, node):
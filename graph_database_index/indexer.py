@@ -1,5 +1,6 @@
 import codecs
 import jedi
+import parso
 
 import os
 import sys
@@ -29,7 +30,17 @@ def isValidEnvironment(environmentPath):
 	return ''
 
 
+_environmentCache = {}
+
+
 def getEnvironment(environmentPath = None):
+	# probing an environment starts a jedi subprocess, so a long-lived worker only does it once per path
+	if environmentPath not in _environmentCache:
+		_environmentCache[environmentPath] = _createEnvironment(environmentPath)
+	return _environmentCache[environmentPath]
+
+
+def _createEnvironment(environmentPath = None):
 	if environmentPath is not None:
 		try:
 			environment = jedi.create_environment(environmentPath, False)
@@ -98,7 +109,65 @@ def indexSourceCode(sourceCode, workingDirectory, astVisitorClient, isVerbose, e
 	astVisitor.traverseNode(module_node)
 
 
-def indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, isVerbose, rootPath):
+class IndexingSession:
+	"""
+	Keeps one jedi evaluator per (root path, environment) and hands it to every file a worker indexes, so that
+	whatever jedi has already inferred about the repo and about site-packages is not thrown away between files.
+	The session resets itself after maxFiles files or once the evaluator caches hold more than maxCacheEntries entries.
+	"""
+
+	def __init__(self, maxFiles = 1000, maxCacheEntries = 500000):
+		self.maxFiles = maxFiles
+		self.maxCacheEntries = maxCacheEntries
+		self.evaluators = {}
+		self.scriptCache = ScriptCache()
+		self.resolutionCache = ResolutionCache()
+		self.indexedFileCount = 0
+
+	def getEvaluator(self, rootPath, environmentPath = None):
+		environment = getEnvironment(environmentPath)
+		key = (rootPath, environment.path)
+		if key not in self.evaluators:
+			project = jedi.api.project.Project(rootPath, environment_path = environment.path)
+			self.evaluators[key] = InferenceState(
+				project,
+				environment=environment,
+				script_path=rootPath
+			)
+		return self.evaluators[key]
+
+	def parse(self, evaluator, sourceFilePath, sourceCode):
+		return evaluator.parse(
+			code=sourceCode,
+			path=sourceFilePath,
+			cache=True,
+			diff_cache=True
+		)
+
+	def getCacheEntryCount(self):
+		count = 0
+		for evaluator in list(self.evaluators.values()) + list(self.scriptCache.inferenceStates.values()):
+			count += len(evaluator.module_cache._name_cache)
+			for functionCache in evaluator.memoize_cache.values():
+				count += len(functionCache)
+		return count
+
+	def fileIndexed(self):
+		self.indexedFileCount += 1
+		if self.maxFiles and self.indexedFileCount >= self.maxFiles:
+			self.reset()
+		elif self.maxCacheEntries and self.getCacheEntryCount() > self.maxCacheEntries:
+			self.reset()
+
+	def reset(self):
+		self.evaluators.clear()
+		self.scriptCache.clear()
+		self.resolutionCache.clear()
+		self.indexedFileCount = 0
+		parso.cache.parser_cache.clear()
+
+
+def indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, isVerbose, rootPath, session = None):
 
 	if isVerbose:
 		print('INFO: Indexing source file "' + sourceFilePath + '".')
@@ -112,30 +181,24 @@ def indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisito
 		with codecs.open(sourceFilePath, 'r') as input:
 			sourceCode=input.read()
 
-	environment = getEnvironment(environmentPath)
+	if session is None:
+		session = IndexingSession()
 
-	if isVerbose:
-		print('INFO: Using Python environment at "' + environment.path + '" for indexing.')
+	evaluator = session.getEvaluator(rootPath or workingDirectory, environmentPath)
 
-	project = jedi.api.project.Project(workingDirectory, environment_path = environment.path)
-
-	evaluator = InferenceState(
-		project,
-		environment=environment,
-		script_path=workingDirectory
-	)
+	if isVerbose:
+		print('INFO: Using Python environment at "' + evaluator.environment.path + '" for indexing.')
 
-	module_node = evaluator.parse(
-		code=sourceCode,
-		path=workingDirectory,
-		cache=False,
-		diff_cache=False
-	)
+	module_node = session.parse(evaluator, sourceFilePath, sourceCode)
 	astVisitorClient.this_source_code_lines = sourceCode.split('\n')
 	if (isVerbose):
-		astVisitor = VerboseAstVisitor(astVisitorClient, evaluator, sourceFilePath)
+		astVisitor = VerboseAstVisitor(astVisitorClient, evaluator, sourceFilePath,
+			scriptCache=session.scriptCache, resolutionCache=session.resolutionCache)
 	else:
-		astVisitor = AstVisitor(astVisitorClient, evaluator, sourceFilePath, rootPath=rootPath)
+		astVisitor = AstVisitor(astVisitorClient, evaluator, sourceFilePath, rootPath=rootPath,
+			scriptCache=session.scriptCache, resolutionCache=session.resolutionCache)
 
 	astVisitor.traverseNode(module_node)
-
+	if isVerbose:
+		print('INFO: Resolution cache ' + str(session.resolutionCache.getStatistics()) + '.')
+	session.fileIndexed()
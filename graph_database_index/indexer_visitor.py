@@ -1,15 +1,24 @@
 import os
 from graph_database_index.index_utils import *
 from graph_database_index.index_utils import _virtualFilePath
-from graph_database_index import sourcetraildb as srctrl
+from graph_database_index import sourcetrail_sink as srctrl
 
 class AstVisitor:
 
-    def __init__(self, client, evaluator, sourceFilePath, sourceFileContent=None, sysPath=None, rootPath=None):
+    def __init__(self, client, evaluator, sourceFilePath, sourceFileContent=None, sysPath=None, rootPath=None,
+                 scriptCache=None, resolutionCache=None):
 
         self.client = client
         self.environment = evaluator.environment
 
+        if scriptCache is None:
+            scriptCache = ScriptCache()
+        self.scriptCache = scriptCache
+        self.scriptCache.beginFile()
+        if resolutionCache is None:
+            resolutionCache = ResolutionCache()
+        self.resolutionCache = resolutionCache
+
         self.sourceFilePath = sourceFilePath
         if sourceFilePath != _virtualFilePath:
             self.sourceFilePath = os.path.abspath(self.sourceFilePath)
@@ -32,6 +41,7 @@ class AstVisitor:
             baseSysPath.sort(reverse=True)
             self.sysPath.extend(baseSysPath)
         self.sysPath = list(filter(None, self.sysPath))
+        self.sysPathKey = tuple(self.sysPath)
 
         self.contextStack = []
 
@@ -656,7 +666,14 @@ class AstVisitor:
         try:
             (startLine, startColumn) = node.start_pos
             script = self.createScript(nodeSourceFilePath)
-            return script.goto(line=startLine, column=startColumn, follow_imports=True)
+            moduleKey = (nodeSourceFilePath, self.sysPathKey)
+            self.resolutionCache.useGeneration(self.scriptCache.generation)
+            contentHash = self.scriptCache.getContentHash(nodeSourceFilePath)
+            definitions = self.resolutionCache.getDefinitions(moduleKey, contentHash, node.start_pos)
+            if definitions is None:
+                definitions = script.goto(line=startLine, column=startColumn, follow_imports=True)
+                self.resolutionCache.setDefinitions(moduleKey, contentHash, node.start_pos, definitions)
+            return definitions
 
         except Exception:
             return []
@@ -673,6 +690,21 @@ class AstVisitor:
         if nameNode is None:
             return None
 
+        try:
+            self.createScript(nodeSourceFilePath)
+        except Exception:
+            return self.resolveNameHierarchyOfNameNode(nameNode, nodeSourceFilePath)
+
+        moduleKey = (nodeSourceFilePath, self.sysPathKey)
+        self.resolutionCache.useGeneration(self.scriptCache.generation)
+        contentHash = self.scriptCache.getContentHash(nodeSourceFilePath)
+        found, nameHierarchy = self.resolutionCache.getNameHierarchy(moduleKey, contentHash, nameNode.start_pos)
+        if not found:
+            nameHierarchy = self.resolveNameHierarchyOfNameNode(nameNode, nodeSourceFilePath)
+            self.resolutionCache.setNameHierarchy(moduleKey, contentHash, nameNode.start_pos, nameHierarchy)
+        return nameHierarchy
+
+    def resolveNameHierarchyOfNameNode(self, nameNode, nodeSourceFilePath):
         # we derive the name for the canonical node (e.g. the node's definition)
         for definition in self.getDefinitionsOfNode(nameNode, nodeSourceFilePath):
             if definition is None:
@@ -734,25 +766,15 @@ class AstVisitor:
         return None
 
     def createScript(self, sourceFilePath):
-        if sourceFilePath == _virtualFilePath:  # we are indexing a provided code snippet
-            return SourcetrailScript(
-                source=self.sourceFileContent,
-                environment=self.environment,
-                sys_path=self.sysPath
-            )
-        else:  # we are indexing a real file
-            return SourcetrailScript(
-                source=None,
-                path=sourceFilePath,
-                environment=self.environment,
-                sys_path=self.sysPath
-            )
+        return self.scriptCache.getScript(sourceFilePath, self.environment, self.sysPath, self.sourceFileContent)
 
 
 class VerboseAstVisitor(AstVisitor):
 
-    def __init__(self, client, evaluator, sourceFilePath, sourceFileContent=None, sysPath=None):
-        AstVisitor.__init__(self, client, evaluator, sourceFilePath, sourceFileContent, sysPath)
+    def __init__(self, client, evaluator, sourceFilePath, sourceFileContent=None, sysPath=None, rootPath=None,
+                 scriptCache=None, resolutionCache=None):
+        AstVisitor.__init__(self, client, evaluator, sourceFilePath, sourceFileContent, sysPath, rootPath, scriptCache,
+                            resolutionCache)
         self.indentationLevel = 0
         self.indentationToken = '| '
 
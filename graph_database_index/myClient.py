@@ -1,22 +1,31 @@
 import codecs
 
-import graph_database_index.sourcetraildb as srctrl
+from graph_database_index import sourcetrail_sink as srctrl
+from graph_database_index.sourcetrail_sink import NullSourcetrailSink
 from graph_database_index.graphDB import GraphDatabaseHandler
+from graph_database_index.incremental import INDEXER_VERSION
 # from graph_database_index.graphDB import GraphDatabaseHandlerNone as GraphDatabaseHandler
 class AstVisitorClient:
 
-	def __init__(self, graphDB: GraphDatabaseHandler, task_root_path=''):
+	def __init__(self, graphDB: GraphDatabaseHandler, task_root_path='', sink=None):
 		self.indexedFileId = 0
-		if srctrl.isCompatible():
-			print('INFO: Loaded database is compatible.')
-		else:
-			print('WARNING: Loaded database is not compatible.')
-			print('INFO: Supported DB Version: ' + str(srctrl.getSupportedDatabaseVersion()))
-			print('INFO: Loaded DB Version: ' + str(srctrl.getLoadedDatabaseVersion()))
+		# 默认只写图数据库，不写 Sourcetrail 数据库
+		if sink is None:
+			sink = NullSourcetrailSink()
+		self.sink = sink
+		if self.sink.isNative:
+			if self.sink.isCompatible():
+				print('INFO: Loaded database is compatible.')
+			else:
+				print('WARNING: Loaded database is not compatible.')
+				print('INFO: Supported DB Version: ' + str(self.sink.getSupportedDatabaseVersion()))
+				print('INFO: Loaded DB Version: ' + str(self.sink.getLoadedDatabaseVersion()))
 		self.task_root_path = task_root_path
 		self.graphDB = graphDB
 		self.this_module = ''
 		self.this_file_path = ''
+		# 当前文件内容的 hash，写在 MODULE 节点上用于增量索引
+		self.this_content_hash = ''
 		self.this_script = None
 		self.this_source_code_lines = []
 		# self.graphDB.clear_database()
@@ -30,6 +39,43 @@ class AstVisitorClient:
 		self.indexedFileId_to_path = {}
 		self.referenceId_to_data = {}
 		self.referenceId_to_data['Unsolved'] = []
+		# 当前文件里每个符号的属性和边先合并在这里，文件结束时 flush 成每个符号一次写入
+		self.staged_nodes = {}
+		self.staged_edges = {}
+
+	def stageNode(self, label, full_name, parms):
+		node = self.staged_nodes.get(full_name)
+		if node is None:
+			self.staged_nodes[full_name] = {'label': label, 'parms': dict(parms)}
+		else:
+			node['parms'].update(parms)
+
+	def stageEdge(self, start_label=None, start_name='', relationship_type='', end_label=None, end_name='', params={}):
+		key = (start_name, relationship_type, end_name)
+		edge = self.staged_edges.get(key)
+		if edge is None:
+			self.staged_edges[key] = {
+				'start_label': start_label,
+				'start_name': start_name,
+				'relationship_type': relationship_type,
+				'end_label': end_label,
+				'end_name': end_name,
+				'params': dict(params),
+			}
+		else:
+			edge['params'].update(params)
+
+	def flush(self):
+		"""
+		写出当前文件暂存的节点和边：先节点后边，每个符号一次 add_node
+		"""
+		for full_name, node in self.staged_nodes.items():
+			self.graphDB.add_node(label=node['label'], full_name=full_name, parms=node['parms'])
+		for edge in self.staged_edges.values():
+			self.graphDB.add_edge(**edge)
+		self.staged_nodes = {}
+		self.staged_edges = {}
+		self.graphDB.flush()
 
 	def process_file_path(self, file_path):
 		if self.task_root_path:
@@ -43,9 +89,23 @@ class AstVisitorClient:
 		# function_def = parsed_code.body[0]
 		# a = 0
 
-	def extract_code_between_lines(self, start_line, end_line, is_indent=True, is_code=True):
-		if is_code:
-			return '<CODE>{{"S":{0},"E":{1},"F":"{2}"}}</CODE>'.format(start_line, end_line, self.this_file_path)
+	def code_location(self, file_path, start_line, end_line):
+		"""
+		节点上只记录代码所在的行号和文件，读取时用 graphDB.hydrate_code 按文件批量取出代码；
+		任务根目录里的文件记录真正的相对路径（去掉开头的分隔符），根目录外的文件保留绝对路径
+		"""
+		if start_line < 1:
+			start_line = 1
+		code_file = file_path
+		if self.task_root_path and file_path.startswith(self.task_root_path):
+			code_file = file_path[len(self.task_root_path):].lstrip('/\\')
+		return {
+			'start_line': start_line,
+			'end_line': end_line,
+			'code_file': code_file,
+		}
+
+	def extract_code_between_lines(self, start_line, end_line, is_indent=True):
 		if start_line < 1:
 			start_line = 1
 		extracted_lines = self.this_source_code_lines[start_line-1:end_line]
@@ -60,9 +120,7 @@ class AstVisitorClient:
 		extracted_code = '\n'.join(extracted_lines)
 		return extracted_code
 
-	def extract_code_from_file(self, file_path, start_line, end_line, is_indent=True, is_code=True):
-		if is_code:
-			return '<CODE>{{"S":{0},"E":{1},"F":"{2}"}}</CODE>'.format(start_line, end_line, file_path)
+	def extract_code_from_file(self, file_path, start_line, end_line, is_indent=True):
 		if start_line < 1:
 			start_line = 1
 		try:
@@ -107,7 +165,7 @@ class AstVisitorClient:
 	def recordSymbol(self, nameHierarchy, node_path='', tree_node=None, global_node=None):
 
 		if nameHierarchy is not None:
-			symbolId = srctrl.recordSymbol(nameHierarchy.serialize())
+			symbolId = self.sink.recordSymbol(nameHierarchy.serialize())
 			# TODO: edge: CONTAINS
 			name = nameHierarchy.getDisplayString()
 			parent_name = nameHierarchy.getParentDisplayString()
@@ -121,12 +179,10 @@ class AstVisitorClient:
 				}
 			if global_node:
 				start_line, end_line = self.get_import_scope_location(global_node)
-				code = self.extract_code_from_file(node_path, start_line-2, end_line+2, is_indent=True)
-				self.symbol_data[name]['code'] = code
+				self.symbol_data[name]['code'] = self.code_location(node_path, start_line-2, end_line+2)
 			if tree_node and node_path:
 				start_line, end_line = self.get_import_scope_location(tree_node)
-				code = self.extract_code_from_file(node_path, start_line, end_line, is_indent=True)
-				self.symbol_data[name]['code'] = code
+				self.symbol_data[name]['code'] = self.code_location(node_path, start_line, end_line)
 				# self.symbol_data[name] = {
 				# 	"name": name,
 				# 	"path": node_path,
@@ -143,7 +199,7 @@ class AstVisitorClient:
 		name = self.symbolId_to_Name[symbolId]
 		kind = symbolDefinitionKindToString(symbolDefinitionKind)
 		# self.symbol_to_Type[name] = kind
-		srctrl.recordSymbolDefinitionKind(symbolId, symbolDefinitionKind)
+		self.sink.recordSymbolDefinitionKind(symbolId, symbolDefinitionKind)
 
 	def recordSymbolKind(self, symbolId, symbolKind):
 		full_name = self.symbolId_to_Name[symbolId]
@@ -152,12 +208,16 @@ class AstVisitorClient:
 		# create node
 		if kind == 'MODULE':
 			if full_name == self.this_module:
-				self.graphDB.add_node(label='MODULE', full_name=full_name, parms={
+				data = {
 					"name": full_name,
 					"file_path": self.process_file_path(self.this_file_path),
-				})
+				}
+				if self.this_content_hash:
+					data['content_hash'] = self.this_content_hash
+					data['indexer_version'] = INDEXER_VERSION
+				self.stageNode(label='MODULE', full_name=full_name, parms=data)
 			else:
-				self.graphDB.add_node(label='MODULE', full_name=full_name, parms={
+				self.stageNode(label='MODULE', full_name=full_name, parms={
 					"name": full_name,
 					"file_path": self.process_file_path(self.symbol_data[full_name]['path'])
 				})
@@ -170,7 +230,7 @@ class AstVisitorClient:
 			if self.symbol_data[full_name]['parent_name'] == self.this_module:
 				data['file_path'] = self.process_file_path(self.this_file_path)
 			if 'code' in self.symbol_data[full_name].keys():
-				data['code'] = self.symbol_data[full_name]['code']
+				data.update(self.symbol_data[full_name]['code'])
 
 			if kind in ['FUNCTION', 'METHOD', 'GLOBAL_VARIABLE', 'FIELD']:
 				parent_class = self.get_parent_class(full_name)
@@ -182,28 +242,28 @@ class AstVisitorClient:
 						kind = 'METHOD'
 						self.symbol_data[full_name]['kind'] = kind
 			# 创建节点 ------------------------------------------------------------------
-			self.graphDB.add_node(label=kind, full_name=full_name, parms=data)
+			self.stageNode(label=kind, full_name=full_name, parms=data)
 			# 边的关系 ------------------------------------------------------------------
 			if kind in ['CLASS', 'FUNCTION', 'GLOBAL_VARIABLE']:
 				module_name = self.get_module_name(full_name)
-				self.graphDB.add_edge(start_label='MODULE', start_name=module_name,
-									  relationship_type='CONTAINS',
-									  end_label=kind, end_name=full_name, params={"association_type": kind})
-				self.graphDB.add_edge(start_label='MODULE', start_name=self.this_module,
-									  relationship_type='CONTAINS',
-									  end_label=kind, end_name=full_name, params={"association_type": kind})
+				self.stageEdge(start_label='MODULE', start_name=module_name,
+							   relationship_type='CONTAINS',
+							   end_label=kind, end_name=full_name, params={"association_type": kind})
+				self.stageEdge(start_label='MODULE', start_name=self.this_module,
+							   relationship_type='CONTAINS',
+							   end_label=kind, end_name=full_name, params={"association_type": kind})
 			if kind == 'METHOD':
 				parent_class = self.get_parent_class(full_name)
-				self.graphDB.add_edge(start_label='CLASS', start_name=parent_class,
-									  relationship_type='HAS_METHOD',
-									  end_label=kind, end_name=full_name)
+				self.stageEdge(start_label='CLASS', start_name=parent_class,
+							   relationship_type='HAS_METHOD',
+							   end_label=kind, end_name=full_name)
 			if kind == 'FIELD':
 				parent_class = self.get_parent_class(full_name)
-				self.graphDB.add_edge(start_label='CLASS', start_name=parent_class,
-									  relationship_type='HAS_FIELD',
-									  end_label=kind, end_name=full_name)
+				self.stageEdge(start_label='CLASS', start_name=parent_class,
+							   relationship_type='HAS_FIELD',
+							   end_label=kind, end_name=full_name)
 
-		srctrl.recordSymbolKind(symbolId, symbolKind)
+		self.sink.recordSymbolKind(symbolId, symbolKind)
 
 	def recordSymbolLocation(self, symbolId, sourceRange):
 		"""
@@ -213,12 +273,12 @@ class AstVisitorClient:
 		kind = self.symbol_data[name]['kind']
 
 		if kind in ['CLASS', 'FUNCTION', 'METHOD']:
-			code = self.extract_code_between_lines(sourceRange.startLine, sourceRange.endLine, is_code=False)
-			self.graphDB.add_node(kind, full_name=name, parms={
+			code = self.extract_code_between_lines(sourceRange.startLine, sourceRange.endLine)
+			self.stageNode(kind, full_name=name, parms={
 				'signature': code.strip()
 			})
 
-		srctrl.recordSymbolLocation(
+		self.sink.recordSymbolLocation(
 			symbolId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -241,13 +301,10 @@ class AstVisitorClient:
 		kind = self.symbol_data[name]['kind']
 
 		if kind in ['CLASS', 'FUNCTION', 'METHOD']:
-			code = self.extract_code_between_lines(sourceRange.startLine, sourceRange.endLine, is_indent=True)
-			self.graphDB.add_node(kind, full_name=name, parms={
-				'code': code
-			})
-			self.extract_signature(code)
+			self.stageNode(kind, full_name=name, parms=self.code_location(
+				self.this_file_path, sourceRange.startLine, sourceRange.endLine))
 
-		srctrl.recordSymbolScopeLocation(
+		self.sink.recordSymbolScopeLocation(
 			symbolId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -262,7 +319,7 @@ class AstVisitorClient:
 		"""
 		name = self.symbolId_to_Name[symbolId]
 
-		srctrl.recordSymbolSignatureLocation(
+		self.sink.recordSymbolSignatureLocation(
 			symbolId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -292,25 +349,25 @@ class AstVisitorClient:
 			contextKind = self.symbol_data[contextName]['kind']
 			referenceNameKind = self.symbol_data[referenceName]['kind']
 			if contextKind != 'MODULE':
-				self.graphDB.add_edge(start_label=contextKind, start_name=contextName,
-									  relationship_type='CALL',
-									  end_label=referenceNameKind, end_name=referenceName)
+				self.stageEdge(start_label=contextKind, start_name=contextName,
+							   relationship_type='CALL',
+							   end_label=referenceNameKind, end_name=referenceName)
 
 		if referenceKindStr in ['USAGE']:
 			contextKind = self.symbol_data[contextName]['kind']
 			referenceNameKind = self.symbol_data[referenceName]['kind']
 			if contextKind in ['FUNCTION', 'METHOD'] and referenceNameKind in ['GLOBAL_VARIABLE', 'FIELD']:
-				self.graphDB.add_edge(start_label=contextKind, start_name=contextName,
-									  relationship_type='USES',
-									  end_label=referenceNameKind, end_name=referenceName)
+				self.stageEdge(start_label=contextKind, start_name=contextName,
+							   relationship_type='USES',
+							   end_label=referenceNameKind, end_name=referenceName)
 		if referenceKindStr == 'INHERITANCE':
 			contextKind = self.symbol_data[contextName]['kind']
 			referenceNameKind = self.symbol_data[referenceName]['kind']
-			self.graphDB.add_edge(start_label=contextKind, start_name=contextName,
-								  relationship_type='INHERITS',
-								  end_label=referenceNameKind, end_name=referenceName)
+			self.stageEdge(start_label=contextKind, start_name=contextName,
+						   relationship_type='INHERITS',
+						   end_label=referenceNameKind, end_name=referenceName)
 
-		referenceId = srctrl.recordReference(contextSymbolId,
+		referenceId = self.sink.recordReference(contextSymbolId,
 											 referencedSymbolId,
 											 referenceKind)
 
@@ -338,7 +395,7 @@ class AstVisitorClient:
 		# 	"startLine": sourceRange.startLine,
 		# 	"endLine": sourceRange.endLine,
 		# }
-		srctrl.recordReferenceLocation(
+		self.sink.recordReferenceLocation(
 			referenceId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -351,7 +408,7 @@ class AstVisitorClient:
 		"""
 		未使用
 		"""
-		return srctrl.recordReferenceIsAmbiguous(referenceId)
+		return self.sink.recordReferenceIsAmbiguous(referenceId)
 
 	def recordReferenceToUnsolvedSymhol(self, contextSymbolId, referenceKind, sourceRange):
 		"""
@@ -370,7 +427,7 @@ class AstVisitorClient:
 		# 	}
 		# })
 
-		return srctrl.recordReferenceToUnsolvedSymhol(
+		return self.sink.recordReferenceToUnsolvedSymhol(
 			contextSymbolId,
 			referenceKind,
 			self.indexedFileId,
@@ -384,7 +441,7 @@ class AstVisitorClient:
 		"""
 		TODO: 暂时当作和recordReferenceLocation一样的
 		"""
-		return srctrl.recordQualifierLocation(
+		return self.sink.recordQualifierLocation(
 			referencedSymbolId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -394,20 +451,20 @@ class AstVisitorClient:
 		)
 
 	def recordFile(self, filePath):
-		self.indexedFileId = srctrl.recordFile(filePath.replace('\\', '/'))
+		self.indexedFileId = self.sink.recordFile(filePath.replace('\\', '/'))
 		self.indexedFileId_to_path[self.indexedFileId] = filePath.replace('\\', '/')
 		self.this_file_path = self.indexedFileId_to_path[self.indexedFileId]
-		srctrl.recordFileLanguage(self.indexedFileId, 'python')
+		self.sink.recordFileLanguage(self.indexedFileId, 'python')
 		return self.indexedFileId
 
 	def recordFileLanguage(self, fileId, languageIdentifier):
-		srctrl.recordFileLanguage(fileId, languageIdentifier)
+		self.sink.recordFileLanguage(fileId, languageIdentifier)
 
 	def recordLocalSymbol(self, name):
-		return srctrl.recordLocalSymbol(name)
+		return self.sink.recordLocalSymbol(name)
 
 	def recordLocalSymbolLocation(self, localSymbolId, sourceRange):
-		srctrl.recordLocalSymbolLocation(
+		self.sink.recordLocalSymbolLocation(
 			localSymbolId,
 			self.indexedFileId,
 			sourceRange.startLine,
@@ -417,7 +474,7 @@ class AstVisitorClient:
 		)
 
 	def recordAtomicSourceRange(self, sourceRange):
-		srctrl.recordAtomicSourceRange(
+		self.sink.recordAtomicSourceRange(
 			self.indexedFileId,
 			sourceRange.startLine,
 			sourceRange.startColumn,
@@ -426,7 +483,7 @@ class AstVisitorClient:
 		)
 
 	def recordError(self, message, fatal, sourceRange):
-		srctrl.recordError(
+		self.sink.recordError(
 			message,
 			fatal,
 			self.indexedFileId,
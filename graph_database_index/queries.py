@@ -0,0 +1,202 @@
+"""
+项目里所有 Cypher 的模板库。
+
+值一律用 $参数 传入；只有标签和关系类型会拼进查询文本，而且必须经过 quote_label 的白名单检查。
+同一组标签渲染出的文本完全相同，Neo4j 可以复用执行计划。模板里的占位符：
+    {task}: 任务标签，渲染成 :`task` （没有任务时为空；TASK_SCOPED_WRITES 里的模板必须带任务）
+    其余占位符（{label}、{rel}、{target} 等）: 渲染成 `LABEL`
+"""
+import re
+import functools
+
+# 节点类型标签
+KIND_LABELS = ['MODULE', 'CLASS', 'FUNCTION', 'METHOD', 'GLOBAL_VARIABLE', 'FIELD']
+
+# 类型还不知道的节点的占位标签
+NONE_LABEL = 'none'
+
+RELATIONSHIP_TYPES = ['CONTAINS', 'HAS_METHOD', 'HAS_FIELD', 'INHERITS', 'CALL', 'USES']
+
+# 任务标签（例如 test_0621、project_cc_python/102）只允许这些字符，不能带反引号
+TASK_LABEL_PATTERN = re.compile(r'^[\w.\-/:@]+$')
+
+# 清空 / 删除 / 改标签 / 关闭版本的模板：任务为空时会作用到库里所有任务，render 直接拒绝
+TASK_SCOPED_WRITES = frozenset([
+    'clear_task', 'add_task_label', 'delete_file_nodes', 'delete_flagged_relations',
+    'versioned_close_files', 'versioned_close_flagged_relations',
+])
+
+# 版本区间存储里把节点 / 边固定在 $version 的条件
+_AT_VERSION = '{0}.valid_from <= $version AND $version < {0}.valid_to'
+
+
+def _at_version(*aliases):
+    return ' AND '.join(_AT_VERSION.format(alias) for alias in aliases)
+
+
+QUERIES = {
+    # 索引和约束 -----------------------------------------------------------------------------
+    'create_unique_full_name': "CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE n.full_name IS UNIQUE",
+    'create_index_full_name': "CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.full_name)",
+    'create_index_name': "CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.name)",
+    'create_index_file_path': "CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.file_path)",
+    'create_node_key_full_name_valid_to': (
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE (n.full_name, n.valid_to) IS NODE KEY"),
+    'create_unique_full_name_valid_to': (
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE (n.full_name, n.valid_to) IS UNIQUE"),
+    'create_index_full_name_valid_to': "CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.full_name, n.valid_to)",
+    'create_index_validity': "CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.valid_from, n.valid_to)",
+
+    # 写入 -----------------------------------------------------------------------------------
+    'merge_nodes': (
+        "UNWIND $rows AS row "
+        "MERGE (n{task} {{full_name: row.full_name}}) "
+        "ON CREATE SET n:{label} "
+        "FOREACH (_ IN CASE WHEN n:{none} THEN [1] ELSE [] END | REMOVE n:{none} SET n:{label}) "
+        # 旧索引器写的 <CODE> 字符串，写入 code_file 之后删掉
+        "FOREACH (_ IN CASE WHEN row.parms.code_file IS NOT NULL THEN [1] ELSE [] END | REMOVE n.code) "
+        "SET n += row.parms"),
+    'merge_edges': (
+        "UNWIND $rows AS row "
+        "MERGE (s{task} {{full_name: row.start_name}}) "
+        "ON CREATE SET s:{start_label}, s += row.params "
+        "MERGE (e{task} {{full_name: row.end_name}}) "
+        "ON CREATE SET e:{end_label}, e += row.params "
+        "MERGE (s)-[r:{rel}]->(e) "
+        "SET r += row.params"),
+    'update_node': "MATCH (n{task} {{full_name: $full_name}}) SET n += $parms",
+    'clear_task': "MATCH (n{task}) DETACH DELETE n",
+    'clear_database': "MATCH (n) DETACH DELETE n",
+    'add_task_label': (
+        "MATCH (n{task}) "
+        "WHERE n.file_path IS NOT NULL AND n.file_path <> '' "
+        "AND NOT n.file_path IN $exclude_files AND NOT n:{target} "
+        "WITH n LIMIT $batch_size "
+        "SET n:{target} "
+        "RETURN count(n) AS relabelled"),
+    'delete_file_nodes': "MATCH (n{task}) WHERE n.file_path IN $file_paths DETACH DELETE n",
+    'delete_flagged_relations': (
+        "MATCH (s{task})-[r:{rel}]->() WHERE s.full_name IN $start_names AND r[$flag] = true DELETE r"),
+
+    # 查询 -----------------------------------------------------------------------------------
+    'match_node': "MATCH (n{task} {{full_name: $full_name}}) RETURN n",
+    'class_by_name': "MATCH (c:CLASS{task} {{name: $name}}) RETURN c",
+    'module_member_by_name': (
+        "MATCH (m:MODULE{task} {{full_name: $module}})-[:CONTAINS]->(c{task} {{name: $name}}) "
+        "RETURN c.full_name as full_name, labels(c) AS labels LIMIT 1"),
+    'module_members': (
+        "MATCH (m:MODULE{task} {{full_name: $module}})-[:CONTAINS]->(c{task}) "
+        "RETURN c.full_name as full_name, labels(c) AS labels"),
+    'class_methods': (
+        "MATCH (c:CLASS{task} {{full_name: $full_name}})-[:HAS_METHOD]->(m{task}) "
+        "RETURN m.full_name as full_name"),
+    'module_contains': (
+        "MATCH (m:MODULE{task})-[:CONTAINS]->(c{task}) "
+        "RETURN m.full_name AS module, c.name AS name, c.full_name AS full_name, labels(c) AS labels"),
+    'relations': (
+        "MATCH (s{task})-[r:{rel}]->(e{task}) "
+        "RETURN s.full_name AS start_name, e.full_name AS end_name, properties(r) AS params"),
+    'indexed_files': (
+        "MATCH (m:MODULE{task}) WHERE m.content_hash IS NOT NULL "
+        "RETURN m.file_path AS file_path, m.content_hash AS content_hash, m.indexer_version AS indexer_version"),
+    'task_nodes_page': (
+        "MATCH (n{task}) WHERE n.full_name > $after "
+        "RETURN n ORDER BY n.full_name LIMIT $page_size"),
+    'nodes_with_file_path': (
+        "MATCH (n{task}) WHERE n.file_path IS NOT NULL "
+        "RETURN n.file_path as file_path, n.full_name as full_name"),
+
+    # 版本区间存储 ---------------------------------------------------------------------------
+    'versioned_merge_nodes': (
+        "UNWIND $rows AS row "
+        "MERGE (n{task} {{full_name: row.full_name, valid_to: $open}}) "
+        "ON CREATE SET n:{label}, n.valid_from = $version "
+        "FOREACH (_ IN CASE WHEN n:{none} THEN [1] ELSE [] END | REMOVE n:{none} SET n:{label}) "
+        # 旧索引器写的 <CODE> 字符串，写入 code_file 之后删掉
+        "FOREACH (_ IN CASE WHEN row.parms.code_file IS NOT NULL THEN [1] ELSE [] END | REMOVE n.code) "
+        "SET n += row.parms"),
+    'versioned_merge_edges': (
+        "UNWIND $rows AS row "
+        "MERGE (s{task} {{full_name: row.start_name, valid_to: $open}}) "
+        "ON CREATE SET s:{start_label}, s += row.params, s.valid_from = $version "
+        "MERGE (e{task} {{full_name: row.end_name, valid_to: $open}}) "
+        "ON CREATE SET e:{end_label}, e += row.params, e.valid_from = $version "
+        "MERGE (s)-[r:{rel} {{valid_to: $open}}]->(e) "
+        "ON CREATE SET r.valid_from = $version "
+        "SET r += row.params"),
+    'versioned_update_node': "MATCH (n{task} {{full_name: $full_name, valid_to: $open}}) SET n += $parms",
+    'versioned_close_files': (
+        "MATCH (n{task}) WHERE n.valid_to = $open AND n.file_path IN $file_paths "
+        "WITH n LIMIT $batch_size "
+        "OPTIONAL MATCH (n)-[r]-() WHERE r.valid_to = $open "
+        "SET n.valid_to = $version, r.valid_to = $version "
+        "RETURN count(DISTINCT n) AS closed"),
+    'versioned_close_flagged_relations': (
+        "MATCH (s{task})-[r:{rel}]->() "
+        "WHERE s.full_name IN $start_names AND r.valid_to = $open AND r[$flag] = true "
+        "SET r.valid_to = $version"),
+    'versioned_indexed_files': (
+        "MATCH (m:MODULE{task}) WHERE m.valid_to = $open AND m.content_hash IS NOT NULL "
+        "RETURN m.file_path AS file_path, m.content_hash AS content_hash, m.indexer_version AS indexer_version"),
+    'versioned_module_contains': (
+        "MATCH (m:MODULE{task})-[r:CONTAINS]->(c{task}) "
+        "WHERE " + _at_version('m', 'r', 'c') + " "
+        "RETURN m.full_name AS module, c.name AS name, c.full_name AS full_name, labels(c) AS labels"),
+    'versioned_relations': (
+        "MATCH (s{task})-[r:{rel}]->(e{task}) "
+        "WHERE " + _at_version('s', 'r', 'e') + " "
+        "RETURN s.full_name AS start_name, e.full_name AS end_name, properties(r) AS params"),
+    'versioned_module_member_by_name': (
+        "MATCH (m:MODULE{task} {{full_name: $module}})-[r:CONTAINS]->(c{task} {{name: $name}}) "
+        "WHERE " + _at_version('m', 'r', 'c') + " "
+        "RETURN c.full_name as full_name, labels(c) AS labels LIMIT 1"),
+    'versioned_module_members': (
+        "MATCH (m:MODULE{task} {{full_name: $module}})-[r:CONTAINS]->(c{task}) "
+        "WHERE " + _at_version('m', 'r', 'c') + " "
+        "RETURN c.full_name as full_name, labels(c) AS labels"),
+    'versioned_task_nodes_page': (
+        "MATCH (n{task}) WHERE n.full_name > $after AND " + _at_version('n') + " "
+        "RETURN n ORDER BY n.full_name LIMIT $page_size"),
+    'versioned_class_methods': (
+        "MATCH (c:CLASS{task} {{full_name: $full_name}})-[r:HAS_METHOD]->(m{task}) "
+        "WHERE " + _at_version('c', 'r', 'm') + " "
+        "RETURN m.full_name as full_name"),
+}
+
+
+def quote_label(label):
+    """
+    白名单检查后给标签 / 关系类型加上反引号；不合法时抛 ValueError
+    """
+    if label in KIND_LABELS or label in RELATIONSHIP_TYPES or label == NONE_LABEL:
+        return '`{0}`'.format(label)
+    if not isinstance(label, str) or not TASK_LABEL_PATTERN.match(label):
+        raise ValueError('Unsafe label or relationship type: {0!r}'.format(label))
+    return '`{0}`'.format(label)
+
+
+@functools.lru_cache(maxsize=1024)
+def _render(name, task, labels):
+    values = {'task': ':' + quote_label(task) if task else ''}
+    for key, label in labels:
+        values[key] = quote_label(label)
+    return QUERIES[name].format(**values)
+
+
+def render(name, task='', **labels):
+    """
+    :param name: QUERIES 里的模板名
+    :param task: 任务标签，为空时匹配所有节点；TASK_SCOPED_WRITES 里的模板任务为空时抛 ValueError
+    :param labels: 模板里其余的标签占位符，例如 label='CLASS'、rel='HAS_METHOD'
+    """
+    if not task and name in TASK_SCOPED_WRITES:
+        raise ValueError('Refusing to render {0!r} without a task label'.format(name))
+    return _render(name, task or '', tuple(sorted(labels.items())))
+
+
+def version_filter(*aliases):
+    """
+    生成把节点 / 边固定在 $version 的 WHERE 条件，例如
+    MATCH (c:CLASS)-[r:HAS_METHOD]->(m) WHERE {version_filter('c', 'r', 'm')} RETURN m
+    """
+    return _at_version(*aliases)
@@ -0,0 +1,158 @@
+"""
+execute_query 的结果缓存（可选开启）。
+key 是 (存储, 任务标签, 规范化后的查询, 参数)，按条数 / 估算字节数做 LRU 淘汰，可以设置 TTL。
+存储是 handler 的 cache_store（Neo4j 为 (uri, database)），同一个任务名在不同的库里互不影响；
+handler 对某个任务的写入和清空会让这个库里这个任务的缓存失效（没有任务标签的写入让这个库的所有缓存失效）
+"""
+import re
+import json
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+QUERY_CACHE_MAX_ENTRIES = 4096
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# 引号 / 反引号里的内容原样保留，其余连续空白压成一个空格
+_NORMALIZE_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)|\s+")
+# 出现这些关键字的查询（Cypher 或 SQL）当作写入：不缓存，并让任务的缓存失效
+_WRITE_PATTERN = re.compile(r'\b(CREATE|MERGE|SET|DELETE|REMOVE|DROP|INSERT|UPDATE|REPLACE|ALTER|LOAD|CALL)\b',
+                            re.IGNORECASE)
+
+# 进程里所有的缓存，handler 写入时逐个失效
+_caches = weakref.WeakSet()
+
+
+def normalize_query(query):
+    return _NORMALIZE_PATTERN.sub(lambda match: match.group(1) or ' ', query).strip()
+
+
+def is_write_query(query):
+    stripped = _NORMALIZE_PATTERN.sub(lambda match: "''" if match.group(1) else ' ', query)
+    return _WRITE_PATTERN.search(stripped) is not None
+
+
+def _params_key(params):
+    if not params:
+        return ''
+    return json.dumps(params, sort_keys=True, default=repr)
+
+
+def _estimate_bytes(result):
+    # py2neo 的 Record 和 sqlite3.Row 都可以转成 tuple，按它们的文本长度粗略估算
+    return sum(len(repr(tuple(record))) for record in result) + 64
+
+
+class QueryResultCache:
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=None):
+        """
+        :param ttl: 结果的有效秒数，None 表示只靠写入失效
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (result, nbytes, 过期时间)
+        self._entries = OrderedDict()
+        # (存储, 任务) -> 失效次数，存储或任务为 None 表示全部；查询开始前后不一致说明期间有写入，结果不能放进缓存
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _caches.add(self)
+
+    def _generation(self, store, task):
+        return tuple(self._generations.get(key, 0) for key in ((store, task), (None, task), (store, None), (None, None)))
+
+    def generation(self, store, task):
+        with self._lock:
+            return self._generation(store, task)
+
+    def get(self, store, task, query, params=None):
+        """
+        :return: (是否命中, 结果)
+        """
+        key = (store, task, normalize_query(query), _params_key(params))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[2] is None or entry[2] > time.time()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, list(entry[0])
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, store, task, query, params, result, generation):
+        """
+        :param generation: 执行查询前 generation(store, task) 的返回值
+        """
+        nbytes = _estimate_bytes(result)
+        if nbytes > self.max_bytes:
+            return
+        key = (store, task, normalize_query(query), _params_key(params))
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation != self._generation(store, task):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (list(result), nbytes, expires)
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    def _bump(self, store, task):
+        self._generations[(store, task)] = self._generations.get((store, task), 0) + 1
+
+    def invalidate(self, task=None, store=None):
+        """
+        :param task: 让这个任务和不带任务标签的缓存失效；为 None 时让整个存储失效
+        :param store: 只影响这个存储的缓存；为 None 时影响所有存储
+        """
+        with self._lock:
+            self.invalidations += 1
+            if task is None or task == '':
+                self._bump(store, None)
+                tasks = None
+            else:
+                self._bump(store, task)
+                self._bump(store, '')
+                tasks = (task, '')
+            for key in [key for key in self._entries.keys()
+                        if (store is None or key[0] == store) and (tasks is None or key[1] in tasks)]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+def invalidate_task(task=None, store=None):
+    """
+    让进程里所有缓存中这个存储里这个任务的结果失效
+    """
+    for cache in list(_caches):
+        cache.invalidate(task, store)
+
+
+# result_cache=True 时共用的缓存
+shared_query_cache = QueryResultCache()
@@ -1,8 +1,10 @@
 import os
+import io
 import sys
 import argparse
-import uuid
 import time
+import contextlib
+import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 动态添加工作目录到 sys.path
@@ -13,56 +15,93 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from graph_database_index import myClient
 from graph_database_index import indexer
 from graph_database_index import shallow_indexer
-from graph_database_index.graphDB import GraphDatabaseHandler
+from graph_database_index.graphDB import GraphDatabaseHandler, create_graph_handler
 # from graph_database_index.graphDB import GraphDatabaseHandlerNone as GraphDatabaseHandler
-import graph_database_index.sourcetraildb as srctrl
+from graph_database_index.sourcetrail_sink import NativeSourcetrailSink
+from graph_database_index.incremental import file_content_hash
 
-def indexSourceFile(sourceFilePath, environmentPath, workingDirectory, graph_db: GraphDatabaseHandler, rootPath, shallow):
+def indexSourceFile(sourceFilePath, environmentPath, workingDirectory, graph_db: GraphDatabaseHandler, rootPath, shallow, session=None,
+                    sink=None):
     # graph_db = GraphDatabaseHandler(uri="http://localhost:7474",
     #                                 user="neo4j",
     #                                 password="12345678",
     #                                 database_name='neo4j',
     #                                 task_id='test2')
 
-    astVisitorClient = myClient.AstVisitorClient(graph_db, task_root_path=rootPath)
+    astVisitorClient = myClient.AstVisitorClient(graph_db, task_root_path=rootPath, sink=sink)
+    astVisitorClient.this_content_hash = file_content_hash(sourceFilePath)
     # astVisitorClient = indexer_sh.AstVisitorClient()
 
     print('use shallow: '+ str(shallow))
 
     if not shallow:
-        indexer.indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, False, rootPath)
+        indexer.indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, False, rootPath, session)
     else:
-        shallow_indexer.indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, False, rootPath)
-
-def run_single(graph_db: GraphDatabaseHandler, sourceFilePath='', root_path='', srctrl_clear=False, shallow=True):
+        shallow_indexer.indexSourceFile(sourceFilePath, environmentPath, workingDirectory, astVisitorClient, False, rootPath, session)
+    # 每个符号合并成一次写入
+    astVisitorClient.flush()
+
+def run_single(graph_db: GraphDatabaseHandler, sourceFilePath='', root_path='', srctrl_clear=False, shallow=True, session=None,
+               srctrl_db_path=None):
+    """
+    :param srctrl_db_path: 需要 Sourcetrail 输出时传入 .srctrldb 的路径；
+        默认只写图数据库，不打开 Sourcetrail 数据库，也不加载 _sourcetraildb
+    """
     workingDirectory = os.getcwd()
-    unique_id = uuid.uuid4()
     print(sourceFilePath)
 
-    tmp_save_folder = os.path.join(workingDirectory, 'tmp')
-    if not os.path.exists(tmp_save_folder):
-        os.makedirs(tmp_save_folder)
-
-    databaseFilePath = os.path.join(tmp_save_folder, 'tmp_{}.srctrldb'.format(unique_id))
-    databaseFile1PrjPath = os.path.join(tmp_save_folder, 'tmp_{}.srctrlprj'.format(unique_id))
+    if srctrl_db_path is None:
+        indexSourceFile(sourceFilePath, None, workingDirectory, graph_db, root_path, shallow, session)
+        return
 
+    sink = NativeSourcetrailSink()
     if srctrl_clear:
-        if not srctrl.clear():
-            print('ERROR: ' + srctrl.getLastError() + sourceFilePath)
-
-    if not srctrl.open(databaseFilePath):
-        print('ERROR: ' + srctrl.getLastError() + sourceFilePath)
-
-    srctrl.beginTransaction()
-    indexSourceFile(sourceFilePath, None, workingDirectory, graph_db, root_path, shallow)
-    srctrl.commitTransaction()
-
-    if not srctrl.close():
-        print('ERROR: ' + srctrl.getLastError() + sourceFilePath)
+        if not sink.clear():
+            print('ERROR: ' + sink.getLastError() + sourceFilePath)
+
+    if not sink.open(srctrl_db_path):
+        print('ERROR: ' + sink.getLastError() + sourceFilePath)
+
+    sink.beginTransaction()
+    indexSourceFile(sourceFilePath, None, workingDirectory, graph_db, root_path, shallow, session, sink)
+    sink.commitTransaction()
+
+    if not sink.close():
+        print('ERROR: ' + sink.getLastError() + sourceFilePath)
+
+class IndexWorker:
+    """
+    常驻的索引 worker：一个进程里连续处理多个文件，
+    import、jedi 环境和图数据库连接在文件之间保持不变
+    """
+    def __init__(self, root_path, task_id, shallow, graph_db: GraphDatabaseHandler = None, version=None):
+        self.root_path = root_path
+        self.task_id = task_id
+        self.shallow = shallow
+        if graph_db is None:
+            graph_db = create_graph_handler(task_id=task_id, batch_size=1000, version=version)
+        self.graph_db = graph_db
+        # 同一个 worker 处理的所有文件共用 jedi evaluator
+        self.session = indexer.IndexingSession()
+        self.generation = 0
+
+    def index_file(self, file_path, generation=0):
+        """
+        索引单个文件，成功时返回和 run_mutiprocess.run_script_in_env 相同格式的输出；
+        失败时抛 RuntimeError（带上捕获的输出和 traceback），IndexWorkerPool.imap 会把它当作失败 yield 出来
+        :param generation: 仓库文件的版本号；变化说明有文件改动，jedi 里推断过的模块都可能过期，整个 session 重建
+        """
+        if generation != self.generation:
+            self.session.reset()
+            self.generation = generation
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                run_single(self.graph_db, file_path, self.root_path, shallow=self.shallow, session=self.session)
+        except Exception:
+            raise RuntimeError("Script execution failed:\n{}{}".format(output.getvalue(), traceback.format_exc()))
+        return "Script executed successfully:\n{}".format(output.getvalue())
 
-    if os.path.exists(databaseFilePath):
-        os.remove(databaseFilePath)
-        os.remove(databaseFile1PrjPath)
 
 def run():
     # task_id = 'test_sh'
@@ -72,6 +111,7 @@ def run():
     parser.add_argument('--task_id', help='task_id', type=str, default='' ,required=False)
     parser.add_argument('--shallow', help='shallow', action='store_true', required=False)
     parser.add_argument('--clear', help='clear', action='store_true', required=False)
+    parser.add_argument('--srctrl_db', help='also write a Sourcetrail database to this path', default=None, required=False)
     args = parser.parse_args()
 
     if args.file_path == '':
@@ -90,16 +130,11 @@ def run():
         is_shallow = args.shallow
         is_clear = args.clear
 
-    graph_db = GraphDatabaseHandler(uri="http://localhost:7474",
-                                    user="neo4j",
-                                    password="12345678",
-                                    database_name='neo4j',
-                                    task_id=task_id,
-                                    use_lock=True)
+    graph_db = create_graph_handler(task_id=task_id)
     if is_clear:
         graph_db.clear_task_data(task_id)
 
-    run_single(graph_db, file_path, root_path, shallow=is_shallow)
+    run_single(graph_db, file_path, root_path, shallow=is_shallow, srctrl_db_path=args.srctrl_db)
     print('Success build graph')
 
 
@@ -4,14 +4,14 @@ import os
 from enum import Enum
 import sys
 import codecs
-import jedi
-from jedi.inference import InferenceState
 
-import graph_database_index.sourcetraildb as srctrl
+from graph_database_index import sourcetrail_sink as srctrl
 from graph_database_index.indexer import SourceRange
 from graph_database_index.indexer import NameHierarchy
 from graph_database_index.indexer import NameElement
 from graph_database_index.indexer import NameHierarchyEncoder
+from graph_database_index.indexer import getEnvironment
+from graph_database_index.indexer import IndexingSession
 
 
 _virtualFilePath = 'virtual_file.py'
@@ -31,47 +31,7 @@ def indexSourceCode(sourceCode, workingDirectory, astVisitorClient, isVerbose, s
 
 	astVisitor.traverseNode(moduleNode)
 
-def getEnvironment(environmentPath = None):
-	if environmentPath is not None:
-		try:
-			environment = jedi.create_environment(environmentPath, False)
-			environment._get_subprocess() # check if this environment is really functional
-			return environment
-		except Exception as e:
-			if os.name == 'nt' and os.path.isdir(environmentPath):
-				try:
-					environment = jedi.create_environment(os.path.join(environmentPath, "python.exe"), False)
-					environment._get_subprocess() # check if this environment is really functional
-					return environment
-				except Exception:
-					pass
-			print('WARNING: The provided environment path "' + environmentPath + '" does not specify a functional Python '
-				'environment (details: "' + str(e) + '"). Using fallback environment instead.')
-
-	try:
-		environment = jedi.get_default_environment()
-		environment._get_subprocess() # check if this environment is really functional
-		return environment
-	except Exception:
-		pass
-
-	try:
-		for environment in jedi.find_system_environments():
-			return environment
-	except Exception:
-		pass
-
-	if os.name == 'nt': # this is just a workaround and shall be removed once Jedi is fixed (Pull request https://github.com/davidhalter/jedi/pull/1282)
-		for version in jedi.api.environment._SUPPORTED_PYTHONS:
-			for exe in jedi.api.environment._get_executables_from_windows_registry(version):
-				try:
-					return jedi.api.environment.Environment(exe)
-				except jedi.InvalidPythonEnvironment:
-					pass
-
-	raise jedi.InvalidPythonEnvironment("Unable to find an executable Python environment.")
-
-def indexSourceFile(sourceFilePath, environmentDirectoryPath, workingDirectory, astVisitorClient, isVerbose, rootPath):
+def indexSourceFile(sourceFilePath, environmentDirectoryPath, workingDirectory, astVisitorClient, isVerbose, rootPath, session = None):
 
 	if isVerbose:
 		print('INFO: Indexing source file "' + sourceFilePath + '".')
@@ -85,25 +45,15 @@ def indexSourceFile(sourceFilePath, environmentDirectoryPath, workingDirectory,
 		with codecs.open(sourceFilePath, 'r') as input:
 			sourceCode=input.read()
 
-	environment = getEnvironment(environmentDirectoryPath)
+	if session is None:
+		session = IndexingSession()
+
+	evaluator = session.getEvaluator(rootPath or workingDirectory, environmentDirectoryPath)
 
 	if isVerbose:
-		print('INFO: Using Python environment at "' + environment.path + '" for indexing.')
-
-	project = jedi.api.project.Project(workingDirectory, environment_path = environment.path)
-
-	evaluator = InferenceState(
-		project,
-		environment=environment,
-		script_path=workingDirectory
-	)
-
-	module_node = evaluator.parse(
-		code=sourceCode,
-		path=workingDirectory,
-		cache=False,
-		diff_cache=False
-	)
+		print('INFO: Using Python environment at "' + evaluator.environment.path + '" for indexing.')
+
+	module_node = session.parse(evaluator, sourceFilePath, sourceCode)
 	astVisitorClient.this_source_code_lines = sourceCode.split('\n')
 	if (isVerbose):
 		astVisitor = VerboseAstVisitor(astVisitorClient, evaluator, sourceFilePath)
@@ -111,6 +61,7 @@ def indexSourceFile(sourceFilePath, environmentDirectoryPath, workingDirectory,
 		astVisitor = AstVisitor(astVisitorClient, evaluator, sourceFilePath, rootPath=rootPath)
 
 	astVisitor.traverseNode(module_node)
+	session.fileIndexed()
 
 class ContextType(Enum):
 	FILE = 1
@@ -0,0 +1,204 @@
+"""
+Sourcetrail 输出端。
+
+索引器只需要 Sourcetrail 分配的 symbol / reference id，真正写 .srctrldb 只在需要 Sourcetrail 输出时才有意义。
+这里的常量和 SourcetrailDB 的枚举同名，访问它们不会加载原生的 _sourcetraildb 模块；
+NativeSourcetrailSink 在写入时按名字把它们转换成原生模块里的值。
+"""
+import itertools
+
+DEFINITION_IMPLICIT = 1
+DEFINITION_EXPLICIT = 2
+
+SYMBOL_TYPE = 0
+SYMBOL_BUILTIN_TYPE = 1
+SYMBOL_MODULE = 2
+SYMBOL_NAMESPACE = 3
+SYMBOL_PACKAGE = 4
+SYMBOL_STRUCT = 5
+SYMBOL_CLASS = 6
+SYMBOL_INTERFACE = 7
+SYMBOL_ANNOTATION = 8
+SYMBOL_GLOBAL_VARIABLE = 9
+SYMBOL_FIELD = 10
+SYMBOL_FUNCTION = 11
+SYMBOL_METHOD = 12
+SYMBOL_ENUM = 13
+SYMBOL_ENUM_CONSTANT = 14
+SYMBOL_TYPEDEF = 15
+SYMBOL_TYPE_PARAMETER = 16
+SYMBOL_FILE = 17
+SYMBOL_MACRO = 18
+SYMBOL_UNION = 19
+
+REFERENCE_TYPE_USAGE = 0
+REFERENCE_USAGE = 1
+REFERENCE_CALL = 2
+REFERENCE_INHERITANCE = 3
+REFERENCE_OVERRIDE = 4
+REFERENCE_TYPE_ARGUMENT = 5
+REFERENCE_TEMPLATE_SPECIALIZATION = 6
+REFERENCE_INCLUDE = 7
+REFERENCE_IMPORT = 8
+REFERENCE_MACRO_USAGE = 9
+REFERENCE_ANNOTATION_USAGE = 10
+
+_DEFINITION_KIND_NAMES = ['DEFINITION_IMPLICIT', 'DEFINITION_EXPLICIT']
+
+_SYMBOL_KIND_NAMES = [
+    'SYMBOL_TYPE', 'SYMBOL_BUILTIN_TYPE', 'SYMBOL_MODULE', 'SYMBOL_NAMESPACE', 'SYMBOL_PACKAGE', 'SYMBOL_STRUCT',
+    'SYMBOL_CLASS', 'SYMBOL_INTERFACE', 'SYMBOL_ANNOTATION', 'SYMBOL_GLOBAL_VARIABLE', 'SYMBOL_FIELD',
+    'SYMBOL_FUNCTION', 'SYMBOL_METHOD', 'SYMBOL_ENUM', 'SYMBOL_ENUM_CONSTANT', 'SYMBOL_TYPEDEF',
+    'SYMBOL_TYPE_PARAMETER', 'SYMBOL_FILE', 'SYMBOL_MACRO', 'SYMBOL_UNION',
+]
+
+_REFERENCE_KIND_NAMES = [
+    'REFERENCE_TYPE_USAGE', 'REFERENCE_USAGE', 'REFERENCE_CALL', 'REFERENCE_INHERITANCE', 'REFERENCE_OVERRIDE',
+    'REFERENCE_TYPE_ARGUMENT', 'REFERENCE_TEMPLATE_SPECIALIZATION', 'REFERENCE_INCLUDE', 'REFERENCE_IMPORT',
+    'REFERENCE_MACRO_USAGE', 'REFERENCE_ANNOTATION_USAGE',
+]
+
+_native = None
+
+
+def loadNative():
+    """
+    第一次需要 Sourcetrail 输出时才加载 SWIG 生成的 sourcetraildb 模块
+    """
+    global _native
+    if _native is None:
+        from graph_database_index import sourcetraildb
+        _native = sourcetraildb
+    return _native
+
+
+def getLastError():
+    if _native is None:
+        return ''
+    return _native.getLastError()
+
+
+class NullSourcetrailSink:
+    """
+    不写任何数据库，只发放稳定的 id：同一个符号 / 文件 / 局部符号 / 引用多次记录得到同一个 id
+    """
+    isNative = False
+
+    def __init__(self):
+        self._nextId = itertools.count(1)
+        self.symbolIds = {}
+        self.fileIds = {}
+        self.localSymbolIds = {}
+        self.referenceIds = {}
+
+    def _getId(self, table, key):
+        if key not in table:
+            table[key] = next(self._nextId)
+        return table[key]
+
+    def isCompatible(self):
+        return True
+
+    def open(self, databaseFilePath):
+        return True
+
+    def close(self):
+        return True
+
+    def clear(self):
+        return True
+
+    def beginTransaction(self):
+        pass
+
+    def commitTransaction(self):
+        pass
+
+    def recordSymbol(self, serializedNameHierarchy):
+        return self._getId(self.symbolIds, serializedNameHierarchy)
+
+    def recordReference(self, contextSymbolId, referencedSymbolId, referenceKind):
+        return self._getId(self.referenceIds, (contextSymbolId, referencedSymbolId, referenceKind))
+
+    def recordReferenceToUnsolvedSymhol(self, contextSymbolId, referenceKind, fileId, startLine, startColumn,
+                                        endLine, endColumn):
+        return next(self._nextId)
+
+    def recordFile(self, filePath):
+        return self._getId(self.fileIds, filePath)
+
+    def recordLocalSymbol(self, name):
+        return self._getId(self.localSymbolIds, name)
+
+    def recordSymbolDefinitionKind(self, symbolId, symbolDefinitionKind):
+        return True
+
+    def recordSymbolKind(self, symbolId, symbolKind):
+        return True
+
+    def recordSymbolLocation(self, symbolId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordSymbolScopeLocation(self, symbolId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordSymbolSignatureLocation(self, symbolId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordReferenceLocation(self, referenceId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordReferenceIsAmbiguous(self, referenceId):
+        return True
+
+    def recordQualifierLocation(self, referencedSymbolId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordFileLanguage(self, fileId, languageIdentifier):
+        return True
+
+    def recordLocalSymbolLocation(self, localSymbolId, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordAtomicSourceRange(self, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+    def recordError(self, message, fatal, fileId, startLine, startColumn, endLine, endColumn):
+        return True
+
+
+class NativeSourcetrailSink:
+    """
+    写入真正的 Sourcetrail 数据库；没有单独实现的方法直接转发给 sourcetraildb 模块
+    """
+    isNative = True
+
+    def __init__(self):
+        self.native = loadNative()
+        self.definitionKinds = self._buildKindMap(_DEFINITION_KIND_NAMES)
+        self.symbolKinds = self._buildKindMap(_SYMBOL_KIND_NAMES)
+        self.referenceKinds = self._buildKindMap(_REFERENCE_KIND_NAMES)
+
+    def _buildKindMap(self, names):
+        kindMap = {}
+        for name in names:
+            if hasattr(self.native, name):
+                kindMap[globals()[name]] = getattr(self.native, name)
+        return kindMap
+
+    def __getattr__(self, name):
+        return getattr(self.native, name)
+
+    def recordSymbolDefinitionKind(self, symbolId, symbolDefinitionKind):
+        return self.native.recordSymbolDefinitionKind(symbolId, self.definitionKinds[symbolDefinitionKind])
+
+    def recordSymbolKind(self, symbolId, symbolKind):
+        return self.native.recordSymbolKind(symbolId, self.symbolKinds[symbolKind])
+
+    def recordReference(self, contextSymbolId, referencedSymbolId, referenceKind):
+        return self.native.recordReference(contextSymbolId, referencedSymbolId, self.referenceKinds[referenceKind])
+
+    def recordReferenceToUnsolvedSymhol(self, contextSymbolId, referenceKind, fileId, startLine, startColumn,
+                                        endLine, endColumn):
+        return self.native.recordReferenceToUnsolvedSymhol(contextSymbolId, self.referenceKinds[referenceKind], fileId,
+                                                           startLine, startColumn, endLine, endColumn)
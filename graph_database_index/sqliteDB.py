@@ -0,0 +1,439 @@
+"""
+嵌入式的 SQLite 图存储，接口和 GraphDatabaseHandler 一致，不需要 Neo4j 服务。
+uri 写成 sqlite:///relative.db、sqlite:////abs/path.db 或 sqlite:///:memory:
+
+nodes: 每个 (task, full_name) 一行，label 是类型标签（MODULE/CLASS/...，未知时为 none），其余属性放在 props(JSON)
+edges: 每个 (task, start_name, rel, end_name) 一行
+多个进程可以写同一个数据库文件：合并属性时的读和写在同一个 BEGIN IMMEDIATE 事务里，不会互相覆盖
+execute_query 接收的是 SQL 而不是 Cypher；AstManager 等模块用 get_member_of_module 之类的方法，两种后端都能用
+"""
+import os
+import json
+import sqlite3
+import threading
+import itertools
+import contextlib
+
+from graph_database_index.graphDB import GraphDatabaseHandler, KIND_LABELS, STREAM_PAGE_SIZE
+from graph_database_index.query_cache import shared_query_cache, invalidate_task, is_write_query
+
+SQLITE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS nodes ("
+    " task TEXT NOT NULL,"
+    " full_name TEXT NOT NULL,"
+    " label TEXT NOT NULL,"
+    " name TEXT,"
+    " file_path TEXT,"
+    " props TEXT NOT NULL DEFAULT '{}',"
+    " PRIMARY KEY (task, full_name))",
+    "CREATE INDEX IF NOT EXISTS nodes_task_name ON nodes (task, name)",
+    "CREATE INDEX IF NOT EXISTS nodes_task_label_name ON nodes (task, label, name)",
+    "CREATE INDEX IF NOT EXISTS nodes_task_file_path ON nodes (task, file_path)",
+    "CREATE TABLE IF NOT EXISTS edges ("
+    " task TEXT NOT NULL,"
+    " start_name TEXT NOT NULL,"
+    " rel TEXT NOT NULL,"
+    " end_name TEXT NOT NULL,"
+    " props TEXT NOT NULL DEFAULT '{}',"
+    " PRIMARY KEY (task, start_name, rel, end_name))",
+    "CREATE INDEX IF NOT EXISTS edges_task_rel_end ON edges (task, rel, end_name)",
+]
+
+# 和 SCHEMA_PROBE_QUERIES 对应的 SQL，用于 schema_usage_report
+SQLITE_PROBE_QUERIES = {
+    'match_node': (
+        "SELECT * FROM nodes WHERE task = ? AND full_name = ?",
+        ('', '')),
+    'module_member_by_name': (
+        "SELECT c.full_name, c.label FROM nodes m "
+        "JOIN edges e ON e.task = m.task AND e.start_name = m.full_name AND e.rel = 'CONTAINS' "
+        "JOIN nodes c ON c.task = e.task AND c.full_name = e.end_name "
+        "WHERE m.task = ? AND m.full_name = ? AND m.label = 'MODULE' AND c.name = ?",
+        ('', '', '')),
+    'module_members': (
+        "SELECT c.full_name, c.label FROM nodes m "
+        "JOIN edges e ON e.task = m.task AND e.start_name = m.full_name AND e.rel = 'CONTAINS' "
+        "JOIN nodes c ON c.task = e.task AND c.full_name = e.end_name "
+        "WHERE m.task = ? AND m.full_name = ? AND m.label = 'MODULE'",
+        ('', '')),
+    'class_methods': (
+        "SELECT e.end_name FROM nodes c "
+        "JOIN edges e ON e.task = c.task AND e.start_name = c.full_name AND e.rel = 'HAS_METHOD' "
+        "WHERE c.task = ? AND c.full_name = ? AND c.label = 'CLASS'",
+        ('', '')),
+    'class_by_name': (
+        "SELECT * FROM nodes WHERE task = ? AND label = 'CLASS' AND name = ?",
+        ('', '')),
+}
+
+SQLITE_MAX_VARIABLES = 900
+
+# :memory: 数据库的编号
+_memory_databases = itertools.count()
+
+
+def sqlite_path_from_uri(uri):
+    if uri.startswith('sqlite:///'):
+        return uri[len('sqlite:///'):]
+    if uri.startswith('sqlite://'):
+        return uri[len('sqlite://'):]
+    return uri
+
+
+class SqliteGraphDatabaseHandler(GraphDatabaseHandler):
+    def __init__(self, uri, task_id='', batch_size=0, ensure_schema=True, timeout=30.0, result_cache=None, **kwargs):
+        """
+        :param uri: sqlite:///path.db
+        :param batch_size: 和 GraphDatabaseHandler 相同，大于 0 时缓冲写入
+        :param result_cache: 和 GraphDatabaseHandler 相同，execute_query 的结果缓存
+        其余 Neo4j 专用的参数（user、password、pool_size 等）会被忽略
+        """
+        self.uri = uri
+        self.path = sqlite_path_from_uri(uri)
+        # 结果缓存按数据库文件区分；每个 :memory: 连接都是独立的库
+        if self.path == ':memory:':
+            self.cache_store = ('sqlite', ':memory:', next(_memory_databases))
+        else:
+            self.cache_store = ('sqlite', os.path.abspath(self.path))
+        if self.path != ':memory:' and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 不用 sqlite3 的隐式事务（它到第一条 INSERT 才开始，之前的读不在事务里），写入都走 _transaction
+        self.connection = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        if self.path != ':memory:':
+            # WAL 模式下读不阻塞写；多个进程的写入靠 _transaction 的 BEGIN IMMEDIATE 排队
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.graph = None
+        self.none_label = 'none'
+        self.task_id = task_id
+        self.lock = threading.RLock()
+        self.batch_size = batch_size
+        self.node_buffer = {}
+        self.edge_buffer = {}
+        self.result_cache = shared_query_cache if result_cache is True else result_cache
+        if ensure_schema:
+            self.ensure_schema()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        BEGIN IMMEDIATE 一开始就拿到数据库的写锁：先读再合并写回的操作里，
+        别的进程不能在读和写之间插入写入（self.lock 只管同一个进程里的线程）
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def ensure_schema(self, task_id=None):
+        with self._transaction():
+            for statement in SQLITE_SCHEMA:
+                self.connection.execute(statement)
+
+    def schema_usage_report(self, queries=None):
+        """
+        对项目自己的查询做 EXPLAIN QUERY PLAN，返回每条查询用到的索引
+        """
+        if queries is None:
+            queries = SQLITE_PROBE_QUERIES
+        report = []
+        for name, (query, params) in queries.items():
+            with self.lock:
+                plan = self.connection.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+            details = [row['detail'] for row in plan]
+            index_operators = [detail for detail in details if 'INDEX' in detail]
+            report.append({'name': name, 'query': query, 'index_operators': index_operators,
+                           'uses_index': len(index_operators) > 0})
+        return report
+
+    def _chunks(self, rows, size=None):
+        size = size or self.batch_size or len(rows) or 1
+        for start in range(0, len(rows), size):
+            yield rows[start:start + size]
+
+    def _fetch_nodes(self, full_names):
+        existing = {}
+        for chunk in self._chunks(list(full_names), SQLITE_MAX_VARIABLES):
+            query = "SELECT full_name, label, props FROM nodes WHERE task = ? AND full_name IN ({0})".format(
+                ','.join('?' * len(chunk)))
+            for row in self.connection.execute(query, [self.task_id] + chunk):
+                existing[row['full_name']] = (row['label'], json.loads(row['props']))
+        return existing
+
+    def _node_row(self, full_name, label, props):
+        return (self.task_id, full_name, label, props.get('name'), props.get('file_path'),
+                json.dumps(props, ensure_ascii=False))
+
+    def _write_node_rows(self, rows, returning=False):
+        """
+        和 Cypher 版本的 MERGE 语义一致：新建时设置标签，已有节点只替换占位的 none 标签，属性合并
+        """
+        merged = {}
+        for row in rows:
+            props = {'full_name': row['full_name']}
+            props.update(row['parms'])
+            merged[row['full_name']] = (row['label'] or self.none_label, props)
+        with self._transaction():
+            existing = self._fetch_nodes(merged.keys())
+            values = []
+            for full_name, (label, props) in merged.items():
+                if full_name in existing:
+                    old_label, old_props = existing[full_name]
+                    if old_label != self.none_label:
+                        label = old_label
+                    if 'code_file' in props:
+                        # 旧索引器写的 <CODE> 字符串，和 Cypher 版本一样删掉
+                        old_props.pop('code', None)
+                    old_props.update(props)
+                    props = old_props
+                merged[full_name] = (label, props)
+                values.append(self._node_row(full_name, label, props))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO nodes (task, full_name, label, name, file_path, props) "
+                "VALUES (?, ?, ?, ?, ?, ?)", values)
+        invalidate_task(self.task_id, self.cache_store)
+        if returning:
+            return [props for label, props in merged.values()]
+        return []
+
+    def _write_edge_rows(self, rows, returning=False):
+        """
+        端点不存在时先建出来（带上边的属性，和 Cypher 里 ON CREATE SET 的行为一致），再合并边的属性
+        """
+        results = []
+        with self._transaction():
+            node_values = []
+            for row in rows:
+                for label, full_name in ((row['start_label'], row['start_name']),
+                                         (row['end_label'], row['end_name'])):
+                    props = {'full_name': full_name}
+                    props.update(row['params'])
+                    node_values.append(self._node_row(full_name, label or self.none_label, props))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO nodes (task, full_name, label, name, file_path, props) "
+                "VALUES (?, ?, ?, ?, ?, ?)", node_values)
+            for row in rows:
+                key = (self.task_id, row['start_name'], row['relationship_type'], row['end_name'])
+                current = self.connection.execute(
+                    "SELECT props FROM edges WHERE task = ? AND start_name = ? AND rel = ? AND end_name = ?",
+                    key).fetchone()
+                props = json.loads(current['props']) if current else {}
+                props.update(row['params'])
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO edges (task, start_name, rel, end_name, props) VALUES (?, ?, ?, ?, ?)",
+                    key + (json.dumps(props, ensure_ascii=False),))
+                if returning:
+                    results.append({'start_name': row['start_name'], 'relationship_type': row['relationship_type'],
+                                    'end_name': row['end_name'], 'properties': props})
+        invalidate_task(self.task_id, self.cache_store)
+        return results
+
+    def clear_task_data(self, task_id):
+        if not task_id:
+            # 和 Neo4j 后端一致：空的任务标签不清空
+            raise ValueError('clear_task_data needs a task id')
+        if task_id == self.task_id:
+            self.node_buffer = {}
+            self.edge_buffer = {}
+        with self._transaction():
+            self.connection.execute("DELETE FROM edges WHERE task = ?", (task_id,))
+            self.connection.execute("DELETE FROM nodes WHERE task = ?", (task_id,))
+        invalidate_task(task_id, self.cache_store)
+
+    def clear_database(self):
+        self.node_buffer = {}
+        self.edge_buffer = {}
+        with self._transaction():
+            self.connection.execute("DELETE FROM edges")
+            self.connection.execute("DELETE FROM nodes")
+        invalidate_task(store=self.cache_store)
+
+    def execute_query(self, query, params=()):
+        """
+        执行 SQL，返回 sqlite3.Row 列表（可以用 record['列名'] 取值）
+        """
+        self.flush()
+
+        def run():
+            with self.lock:
+                return self.connection.execute(query, params).fetchall()
+        try:
+            return self._cached_query(query, params, run)
+        except sqlite3.Error:
+            return ''
+
+    def stream_query(self, query, params=(), page_size=STREAM_PAGE_SIZE):
+        """
+        逐条 yield sqlite3.Row；每次只在锁里 fetchmany 一页，页与页之间不持有锁。出错时抛出 sqlite3.Error
+        """
+        self.flush()
+        with self.lock:
+            cursor = self.connection.execute(query, params)
+        if is_write_query(query):
+            invalidate_task(self.task_id, self.cache_store)
+        while True:
+            with self.lock:
+                page = cursor.fetchmany(page_size)
+            if not page:
+                return
+            for row in page:
+                yield row
+
+    def iter_task_nodes(self, page_size=STREAM_PAGE_SIZE):
+        """
+        按 full_name 分页取出任务里的所有节点，yield 节点属性 dict
+        """
+        after = ''
+        while True:
+            page = list(self.stream_query(
+                "SELECT full_name, props FROM nodes WHERE task = ? AND full_name > ? ORDER BY full_name LIMIT ?",
+                (self.task_id, after, page_size)))
+            for row in page:
+                yield json.loads(row['props'])
+            if len(page) < page_size:
+                return
+            after = page[-1]['full_name']
+
+    def update_node(self, full_name, parms={}):
+        self.flush()
+        with self._transaction():
+            existing = self._fetch_nodes([full_name])
+            if full_name not in existing:
+                return
+            label, props = existing[full_name]
+            props.update(parms)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO nodes (task, full_name, label, name, file_path, props) "
+                "VALUES (?, ?, ?, ?, ?, ?)", self._node_row(full_name, label, props))
+        invalidate_task(self.task_id, self.cache_store)
+
+    def update_file_path(self, root_path):
+        self.flush()
+        rows = self.execute_query(
+            "SELECT full_name FROM nodes WHERE task = ? AND substr(file_path, 1, ?) = ?",
+            (self.task_id, len(root_path), root_path))
+        for row in rows:
+            label, props = self._fetch_nodes([row['full_name']])[row['full_name']]
+            self.update_node(row['full_name'], {'file_path': props['file_path'][len(root_path):]})
+
+    def add_task_label(self, source_task, target_task, exclude_files=(), batch_size=10000):
+        """
+        SQLite 里每个任务是独立的行：按 rowid 分批把节点复制到 target_task，
+        再复制两端都在 target_task 里的边
+        """
+        self.flush()
+        with self.lock:
+            with self._transaction():
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS exclude_files (file_path TEXT PRIMARY KEY)")
+                self.connection.execute("DELETE FROM exclude_files")
+                self.connection.executemany("INSERT OR IGNORE INTO exclude_files VALUES (?)",
+                                            [(file_path,) for file_path in exclude_files])
+            bounds = self.connection.execute("SELECT min(rowid), max(rowid) FROM nodes WHERE task = ?",
+                                             (source_task,)).fetchone()
+            total = 0
+            if bounds[0] is not None:
+                for start in range(bounds[0], bounds[1] + 1, batch_size):
+                    with self._transaction():
+                        cursor = self.connection.execute(
+                            "INSERT OR IGNORE INTO nodes (task, full_name, label, name, file_path, props) "
+                            "SELECT ?, full_name, label, name, file_path, props FROM nodes "
+                            "WHERE task = ? AND rowid >= ? AND rowid < ? AND file_path IS NOT NULL AND file_path <> '' "
+                            "AND file_path NOT IN (SELECT file_path FROM exclude_files)",
+                            (target_task, source_task, start, start + batch_size))
+                    total += cursor.rowcount
+                    print('Relabelled {0} nodes `{1}` -> `{2}`'.format(total, source_task, target_task))
+            with self._transaction():
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO edges (task, start_name, rel, end_name, props) "
+                    "SELECT ?, e.start_name, e.rel, e.end_name, e.props FROM edges e "
+                    "WHERE e.task = ? "
+                    "AND EXISTS (SELECT 1 FROM nodes s WHERE s.task = ? AND s.full_name = e.start_name) "
+                    "AND EXISTS (SELECT 1 FROM nodes t WHERE t.task = ? AND t.full_name = e.end_name)",
+                    (target_task, source_task, target_task, target_task))
+        invalidate_task(target_task, self.cache_store)
+        return total
+
+    def get_indexed_files(self):
+        rows = self.execute_query("SELECT file_path, props FROM nodes WHERE task = ? AND label = 'MODULE'",
+                                  (self.task_id,))
+        indexed = {}
+        for row in rows or []:
+            props = json.loads(row['props'])
+            if props.get('content_hash') is not None:
+                indexed[row['file_path']] = (props['content_hash'], props.get('indexer_version'))
+        return indexed
+
+    def delete_file_nodes(self, file_paths):
+        self.flush()
+        with self._transaction():
+            for chunk in self._chunks(list(file_paths), SQLITE_MAX_VARIABLES):
+                placeholders = ','.join('?' * len(chunk))
+                self.connection.execute(
+                    "DELETE FROM edges WHERE task = ? AND (start_name IN "
+                    "(SELECT full_name FROM nodes WHERE task = ? AND file_path IN ({0})) OR end_name IN "
+                    "(SELECT full_name FROM nodes WHERE task = ? AND file_path IN ({0})))".format(placeholders),
+                    [self.task_id, self.task_id] + chunk + [self.task_id] + chunk)
+                self.connection.execute(
+                    "DELETE FROM nodes WHERE task = ? AND file_path IN ({0})".format(placeholders),
+                    [self.task_id] + chunk)
+        invalidate_task(self.task_id, self.cache_store)
+
+    def get_module_contains(self):
+        self.flush()
+        query = (
+            "SELECT m.full_name AS module, c.name AS name, c.full_name AS full_name, c.label AS label FROM nodes m "
+            "JOIN edges e ON e.task = m.task AND e.start_name = m.full_name AND e.rel = 'CONTAINS' "
+            "JOIN nodes c ON c.task = e.task AND c.full_name = e.end_name "
+            "WHERE m.task = ? AND m.label = 'MODULE'"
+        )
+        with self.lock:
+            rows = self.connection.execute(query, (self.task_id,)).fetchall()
+        for row in rows:
+            if row['label'] in KIND_LABELS:
+                yield row['module'], row['name'], row['full_name'], row['label']
+
+    def get_relations(self, relationship_type, with_params=False):
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute("SELECT start_name, end_name, props FROM edges WHERE task = ? AND rel = ?",
+                                           (self.task_id, relationship_type)).fetchall()
+        for row in rows:
+            if with_params:
+                yield row['start_name'], row['end_name'], json.loads(row['props'])
+            else:
+                yield row['start_name'], row['end_name']
+
+    def delete_relations(self, relationship_type, start_names, flag):
+        self.flush()
+        with self._transaction():
+            for chunk in self._chunks(list(start_names), SQLITE_MAX_VARIABLES):
+                self.connection.execute(
+                    "DELETE FROM edges WHERE task = ? AND rel = ? AND start_name IN ({0}) "
+                    "AND json_extract(props, ?) = 1".format(','.join('?' * len(chunk))),
+                    [self.task_id, relationship_type] + chunk + ['$.' + flag])
+        invalidate_task(self.task_id, self.cache_store)
+
+    def get_member_of_module(self, module_full_name, name):
+        rows = self.execute_query(
+            SQLITE_PROBE_QUERIES['module_member_by_name'][0] + " LIMIT 1",
+            (self.task_id, module_full_name, name))
+        if rows and rows[0]['label'] in KIND_LABELS:
+            return rows[0]['full_name'], rows[0]['label']
+        return None, None
+
+    def get_members_of_module(self, module_full_name):
+        rows = self.execute_query(SQLITE_PROBE_QUERIES['module_members'][0], (self.task_id, module_full_name))
+        return [[row['full_name'], row['label']] for row in rows or [] if row['label'] in KIND_LABELS]
+
+    def get_methods_of_class(self, class_full_name):
+        rows = self.execute_query(SQLITE_PROBE_QUERIES['class_methods'][0], (self.task_id, class_full_name))
+        return [row['end_name'] for row in rows or []]
@@ -1,9 +1,14 @@
 import subprocess
 import concurrent.futures
+import multiprocessing
 import os
 import time
 from ast_search.ast_manage import AstManager
-from graph_database_index.graphDB import clear_task, update_file_path
+from graph_database_index.graphDB import clear_task, update_file_path, create_graph_handler
+from graph_database_index.incremental import prepare_incremental_index
+from ast_search.dependency_index import DependencyIndex, dependency_index_path
+
+ENV_PATH = '/root/miniconda3/envs/srctrl'
 
 class TimerDecorator:
     def __init__(self, func):
@@ -56,7 +61,7 @@ def run_script_in_env(env_path, script_path, working_directory, script_args=None
 
 def run_single(path, root, task_id, shallow):
     # 定义虚拟环境和脚本路径
-    env_path = '/root/miniconda3/envs/srctrl'
+    env_path = ENV_PATH
     script_path = '/home/lanbo/code_database/graph_database_index/run_index_single.py'
     working_directory = '/home/lanbo/code_database'
 
@@ -66,20 +71,120 @@ def run_single(path, root, task_id, shallow):
         script_args = ['--file_path', path, '--root_path', root, '--task_id', task_id]
     return run_script_in_env(env_path, script_path, working_directory, script_args)
 
+
+# 每个 worker 进程里常驻的 IndexWorker
+_worker = None
+
+
+def _init_worker(root, task_id, shallow, version=None):
+    global _worker
+    from graph_database_index.run_index_single import IndexWorker
+    _worker = IndexWorker(root, task_id, shallow, version=version)
+
+
+def _index_in_worker(path, generation=0):
+    return _worker.index_file(path, generation)
+
+
+class IndexWorkerPool:
+    """
+    常驻进程池：每个进程只初始化一次 (import / jedi 环境 / 图数据库连接)，然后连续索引多个文件。
+    某个文件把 worker 弄崩溃 (例如 _sourcetraildb 段错误) 时，进程池会被重建，
+    未完成的文件重新提交，只有单独运行时仍然崩溃的文件才报错。
+    """
+    def __init__(self, root, task_id, shallow, max_workers=6, version=None):
+        self.root = root
+        self.task_id = task_id
+        self.shallow = shallow
+        self.version = version
+        self.max_workers = max_workers
+        self.executor = None
+        # 文件改动后加一，worker 看到新的版本号时丢掉 jedi 缓存
+        self.generation = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self.executor is not None:
+            return
+        context = multiprocessing.get_context('spawn')
+        python_executable = os.path.join(ENV_PATH, 'bin', 'python')
+        if os.path.exists(python_executable):
+            context.set_executable(python_executable)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                               mp_context=context,
+                                                               initializer=_init_worker,
+                                                               initargs=(self.root, self.task_id, self.shallow,
+                                                                         self.version))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def invalidate(self):
+        """
+        仓库里有文件改动了：之后提交的文件会让每个 worker 先重建 jedi session
+        """
+        self.generation += 1
+
+    def imap(self, path_list):
+        """
+        按完成顺序 yield (path, output)，索引失败时 output 是一个 Exception。
+        进程池崩溃时所有未完成的文件都会收到 BrokenProcessPool，分不清是谁导致的：
+        第一次重新批量提交，再次赶上崩溃的文件改为逐个单独运行，只有单独运行时崩溃的文件才报错
+        """
+        pending = list(path_list)
+        isolated = []
+        crashes = {}
+        while pending or isolated:
+            self.start()
+            if pending:
+                batch, pending = pending, []
+            else:
+                batch = [isolated.pop(0)]
+            futures = {self.executor.submit(_index_in_worker, path, self.generation): path for path in batch}
+            broken = False
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    yield path, future.result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    broken = True
+                    crashes[path] = crashes.get(path, 0) + 1
+                    if len(batch) == 1:
+                        yield path, e
+                    elif crashes[path] > 1:
+                        isolated.append(path)
+                    else:
+                        pending.append(path)
+                except Exception as e:
+                    yield path, e
+            if broken:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
 @TimerDecorator
-def main(path_list, root, task_id, shallow, max_workers=6):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(run_single, path, root, task_id, shallow): path for path in path_list}
-        for future in concurrent.futures.as_completed(futures):
-            path = futures[future]
-            try:
-                result = future.result()
+def main(path_list, root, task_id, shallow, max_workers=6, version=None):
+    with IndexWorkerPool(root, task_id, shallow, max_workers=max_workers, version=version) as pool:
+        for path, result in pool.imap(path_list):
+            if isinstance(result, Exception):
+                print("Error ============================ processing {}: {}".format(path, result))
+            else:
                 print("Output =========================== {}:\n{}".format(path, result))
-            except Exception as e:
-                print("Error ============================ processing {}: {}".format(path, e))
 
 
-def run(repo_path=None, task_id='test', max_workers=8):
+def run(repo_path=None, task_id='test', max_workers=8, incremental=True, version=None):
+    """
+    :param incremental: 跳过内容和索引器版本都没变的文件；改动 / 删除文件的旧节点先删除（版本区间存储下在新版本关闭）
+    :param version: 不为 None 时写入版本区间存储
+    """
 
     root_path = ''
     # task_id = 'test_sh'
@@ -87,6 +192,13 @@ def run(repo_path=None, task_id='test', max_workers=8):
     if repo_path:
         file_list = get_py_files(repo_path)
         root_path = repo_path
+        # 保存 import 依赖索引，update_version 用它找出受改动影响的文件
+        dependency_index = DependencyIndex.load(dependency_index_path(task_id), root_path)
+        dependency_index.update(file_list)
+        dependency_index.save(dependency_index_path(task_id))
+        if incremental:
+            file_list = prepare_incremental_index(create_graph_handler(task_id=task_id, version=version),
+                                                  file_list, root_path, dependency_index)
     else:
         file_list = [
             # r"/home/lanbo/repo/sklearn/metrics/cluster/__init__.py",
@@ -98,7 +210,7 @@ def run(repo_path=None, task_id='test', max_workers=8):
             # r"/home/lanbo/cceval_pipeline/cceval/data/crosscodeeval_rawdata/turboderp-exllama-a544085/example_alt_generator.py"
         ]
     # print(len(file_list))
-    main(file_list, root_path, task_id, shallow=True, max_workers=max_workers)
+    main(file_list, root_path, task_id, shallow=True, max_workers=max_workers, version=version)
 
 # @TimerDecorator
 # def run_update_file_path(task_id, repo_path):
@@ -1,8 +1,9 @@
 import os.path
 import git
-from graph_database_index.graphDB import GraphDatabaseHandler
+from graph_database_index.graphDB import create_graph_handler
 from run_mutiprocess import main as multiprocess_graph_index
 from ast_search.ast_manage import AstManager
+from ast_search.dependency_index import DependencyIndex, dependency_index_path
 
 """
 repo version 1 --> repo version 2
@@ -19,29 +20,34 @@ repo version 1 --> repo version 2
 """
 
 def add_new_label_in_old_node(task_id_old, task_id_new, change_list: list):
-    graphDB = GraphDatabaseHandler(uri="http://localhost:7474",
-                                    user="neo4j",
-                                    password="12345678",
-                                    database_name='neo4j',
-                                    task_id=task_id_old,
-                                    use_lock=True)
-
-    query = f"MATCH (m:`{task_id_old}`) RETURN m"
-    nodes = graphDB.execute_query(query)
-
-    for node in nodes:
-        node_id = node['m'].identity
-        node_properties = dict(node['m'])
-        node_path = node_properties.get('file_path', None)  # 获取file_path属性，如果不存在则为None
-        if node_path and node_path not in change_list:
-            query_add = f"""
-MATCH (n)
-WHERE id(n) = {node_id}
-SET n:`{task_id_new}`
-"""
-            graphDB.execute_query(query_add)
+    graphDB = create_graph_handler(task_id=task_id_old)
+
+    # 服务端分批加标签，change_list 作为参数传入；没有 file_path 的节点（第三方库）和改动文件的节点不加
+    count = graphDB.add_task_label(task_id_old, task_id_new, exclude_files=change_list)
+
+    print(f"Added label `{task_id_new}` to {count} nodes.")
 
-    print(f"Added label `{task_id_new}` to {len(nodes)} nodes.")
+
+def update_version_in_place(task_id, version, change_list: list, root_path):
+    """
+    多版本存储：所有版本在同一个 task_id 下，用 valid_from / valid_to 区分，不复制未改动的节点。
+    第一个版本用 run_mutiprocess.run(repo_path, task_id, version=0) 建立
+    :param version: 新版本号，必须大于已经写入的版本
+    """
+    affected_list = get_affected_files(task_id, task_id, change_list, root_path)
+
+    graphDB = create_graph_handler(task_id=task_id, version=version)
+    graphDB.begin_version(affected_list)
+
+    change_files = []
+    for file in affected_list:
+        new_file_path = os.path.join(root_path, file)
+        if os.path.exists(new_file_path):
+            change_files.append(new_file_path)
+    multiprocess_graph_index(change_files, root_path, task_id, shallow=True, max_workers=2, version=version)
+
+    ast_manage = AstManager(root_path, task_id, version=version)
+    ast_manage.run(py_files=change_files)
 
 
 def get_change_list(repo_path, commit1, commit2):
@@ -55,21 +61,35 @@ def get_change_list(repo_path, commit1, commit2):
 
     return change_list
 
+def get_affected_files(task_id_old, task_id_new, change_list: list, root_path):
+    """
+    改动文件 + 传递地 import 了它们的文件；依赖索引从旧版本的 sidecar 增量更新后保存为新版本的
+    """
+    dependency_index = DependencyIndex.load(dependency_index_path(task_id_old), root_path)
+    dependency_index.update()
+    dependency_index.save(dependency_index_path(task_id_new))
+    dependents = dependency_index.dependents(change_list)
+    print(f"{len(change_list)} changed files, {len(dependents)} dependent files")
+    return list(change_list) + dependents
+
+
 def update_version(task_id_old, task_id_new, change_list: list, root_path):
-    add_new_label_in_old_node(task_id_old, task_id_new, change_list)
+    # 0. 改动文件和依赖它们的文件都要重新生成，它们的旧节点不带到新版本 ----------
+    affected_list = get_affected_files(task_id_old, task_id_new, change_list, root_path)
+    add_new_label_in_old_node(task_id_old, task_id_new, affected_list)
 
     # 1. 改为绝对路径 -----------------------------------------
     change_files = []
-    for file in change_list:
+    for file in affected_list:
         new_file_path = os.path.join(root_path, file)
         if os.path.exists(new_file_path):
             change_files.append(new_file_path)
     # 2. indexing change file ------------------------------
     multiprocess_graph_index(change_files, root_path, task_id_new, shallow=True, max_workers=2)
 
-    # 3. ast manager ---------------------------------------
-    ast_manage = AstManager(repo_path, task_id_new)
-    ast_manage.run()
+    # 3. ast manager：只处理受影响的文件 ----------------------
+    ast_manage = AstManager(root_path, task_id_new)
+    ast_manage.run(py_files=change_files)
     print(ast_manage.class_inherited)
 
 
@@ -0,0 +1,211 @@
+"""
+常驻的监听模式：轮询工作区的 .py 文件，事件去抖后把一段时间内的改动合并成一批，
+用常驻的 IndexWorkerPool 只重新索引改动的文件和依赖它们的文件，再对这些文件跑 AstManager。
+status() 给出图落后文件系统多久 (lag_seconds)
+"""
+import os
+import time
+import argparse
+from run_mutiprocess import IndexWorkerPool, get_py_files
+from ast_search.ast_manage import AstManager
+from ast_search.dependency_index import DependencyIndex, dependency_index_path
+from graph_database_index.graphDB import create_graph_handler
+from graph_database_index.incremental import file_content_hash, relative_file_path, prepare_incremental_index
+
+
+class RepoWatcher:
+    def __init__(self, root_path, task_id, poll_interval=0.5, debounce=1.0, max_workers=2, shallow=True):
+        """
+        :param poll_interval: 两次扫描文件系统的间隔（秒）
+        :param debounce: 最后一次改动之后安静这么久才开始索引，连续保存会合并成一批
+        """
+        self.root_path = root_path
+        self.task_id = task_id
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.pool = IndexWorkerPool(root_path, task_id, shallow, max_workers=max_workers)
+        self.graph_db = create_graph_handler(task_id=task_id)
+        self.dependency_index = DependencyIndex.load(dependency_index_path(task_id), root_path)
+        self.snapshot = {}
+        self.hashes = {}
+        # path -> 第一次看到这个改动的时间
+        self.pending = {}
+        # path -> 最近一次看到改动的时间，处理期间又改过的文件不从 pending 里移除
+        self.last_change = {}
+        self.last_event_time = 0.0
+        self.last_sync_time = None
+        self.last_batch_seconds = 0.0
+        self.batches = 0
+        self.files_indexed = 0
+
+    def _scan(self):
+        snapshot = {}
+        for file_path in get_py_files(self.root_path):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            snapshot[file_path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def start(self):
+        """
+        启动时先和图对一次账：监听停掉期间改动 / 新增的文件放进 pending，已删除文件的节点直接清掉
+        """
+        self.pool.start()
+        self.snapshot = self._scan()
+        for file_path in self.snapshot.keys():
+            self.hashes[file_path] = file_content_hash(file_path)
+        self.dependency_index.update(list(self.snapshot.keys()))
+        now = time.time()
+        for file_path in prepare_incremental_index(self.graph_db, list(self.snapshot.keys()), self.root_path,
+                                                   self.dependency_index):
+            # 不记 hash，process_pending 才会把它当作改动的文件
+            self.hashes.pop(file_path, None)
+            self.pending.setdefault(file_path, now)
+        self.last_sync_time = now
+
+    def close(self):
+        self.pool.close()
+        self.graph_db.flush()
+        self.dependency_index.save(dependency_index_path(self.task_id))
+
+    def poll(self):
+        """
+        扫描一次文件系统，记录改动；返回新发现的改动数
+        """
+        now = time.time()
+        snapshot = self._scan()
+        changed = [path for path, stat in snapshot.items() if self.snapshot.get(path) != stat]
+        changed.extend(path for path in self.snapshot.keys() if path not in snapshot)
+        self.snapshot = snapshot
+        for path in changed:
+            self.pending.setdefault(path, now)
+            self.last_change[path] = now
+        if changed:
+            self.last_event_time = now
+        return len(changed)
+
+    def lag(self):
+        """
+        最早一个还没写入图的改动距今多久；没有待处理改动时为 0
+        """
+        if not self.pending:
+            return 0.0
+        return time.time() - min(self.pending.values())
+
+    def status(self):
+        return {
+            'pending_files': len(self.pending),
+            'lag_seconds': self.lag(),
+            'last_sync_time': self.last_sync_time,
+            'last_batch_seconds': self.last_batch_seconds,
+            'batches': self.batches,
+            'files_indexed': self.files_indexed,
+        }
+
+    def ready(self):
+        return bool(self.pending) and time.time() - self.last_event_time >= self.debounce
+
+    def process_pending(self):
+        """
+        处理一批去抖后的改动：只保存时间变了但内容没变的文件直接跳过。
+        成功索引的文件才从 pending 里移除、记下新的 hash；失败的文件留在 pending 里、hash 不更新，
+        去抖之后重试，lag 也会继续增长
+        """
+        start_time = time.time()
+        batch = dict(self.pending)
+
+        changed, deleted = [], []
+        hashes = {}
+        for path in batch.keys():
+            if not os.path.exists(path):
+                deleted.append(path)
+                continue
+            content_hash = file_content_hash(path)
+            if self.hashes.get(path) == content_hash:
+                continue
+            hashes[path] = content_hash
+            changed.append(path)
+        if not changed and not deleted:
+            self._finish_batch(batch, start_time)
+            return
+
+        self.dependency_index.update_paths(changed, deleted)
+        dependents = self.dependency_index.dependents([os.path.relpath(path, self.root_path)
+                                                       for path in changed + deleted])
+        affected = changed + [os.path.join(self.root_path, path) for path in dependents
+                              if os.path.join(self.root_path, path) not in changed]
+
+        # MERGE 只会新增和更新：先删掉（版本区间存储下是关闭）这些文件的旧节点和边，
+        # 否则删掉的函数、类、调用边以及已经被覆盖的继承方法会一直留在图里
+        self.graph_db.delete_file_nodes([relative_file_path(path, self.root_path) for path in affected + deleted])
+        self.pool.invalidate()
+        failed = set()
+        for path, result in self.pool.imap(affected):
+            if isinstance(result, Exception):
+                failed.add(path)
+                print("Error ============================ processing {}: {}".format(path, result))
+        indexed = [path for path in affected if path not in failed]
+        ast_manage = AstManager(self.root_path, self.task_id)
+        ast_manage.run(py_files=indexed)
+
+        for path in deleted:
+            self.hashes.pop(path, None)
+        self.hashes.update((path, content_hash) for path, content_hash in hashes.items() if path not in failed)
+        for path in failed:
+            # 旧节点已经删掉了：依赖它的文件内容没变，也要去掉 hash 才会在下一批重试
+            self.hashes.pop(path, None)
+            self.pending.setdefault(path, batch.get(path, start_time))
+        self._finish_batch(batch, start_time, keep=failed)
+        if failed:
+            self.last_event_time = time.time()
+        self.batches += 1
+        self.files_indexed += len(indexed)
+        self.last_sync_time = time.time()
+        self.last_batch_seconds = self.last_sync_time - start_time
+        print('Synced {0} changed, {1} dependent, {2} deleted files, {3} failed in {4:.2f}s (lag {5:.2f}s)'.format(
+            len(changed), len(affected) - len(changed), len(deleted), len(failed), self.last_batch_seconds,
+            self.last_sync_time - min(batch.values())))
+
+    def _finish_batch(self, batch, start_time, keep=()):
+        """
+        :param keep: 这一批里失败的文件，留在 pending 里重试
+        """
+        for path in batch.keys():
+            # 处理期间又记录的新改动保留
+            if path not in keep and self.last_change.get(path, 0) < start_time:
+                self.pending.pop(path, None)
+                self.last_change.pop(path, None)
+
+    def run_forever(self):
+        self.start()
+        try:
+            while True:
+                self.poll()
+                if self.ready():
+                    try:
+                        self.process_pending()
+                    except Exception as e:
+                        # 改动还在 pending 里，再等一个去抖周期后重试
+                        print('Error ============================ syncing {0} files: {1}'.format(len(self.pending), e))
+                        self.last_event_time = time.time()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep the code graph of a working tree up to date.')
+    parser.add_argument('--root_path', required=True)
+    parser.add_argument('--task_id', required=True)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between file system scans')
+    parser.add_argument('--debounce', type=float, default=1.0, help='quiet period before a batch is indexed')
+    parser.add_argument('--max_workers', type=int, default=2)
+    args = parser.parse_args()
+
+    watcher = RepoWatcher(args.root_path, args.task_id, poll_interval=args.interval, debounce=args.debounce,
+                          max_workers=args.max_workers)
+    watcher.run_forever()